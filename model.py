@@ -1,23 +1,28 @@
+import math
 from functools import reduce, lru_cache
 from operator import mul
-from torch.autograd import Variable, Function
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from timm.models.layers import DropPath, trunc_normal_
 
+try:
+    from torch.nn.attention.flex_attention import BlockMask, flex_attention, create_block_mask
+except ImportError:  # torch < 2.5
+    BlockMask = flex_attention = create_block_mask = None
+
 
 class ConvNormAct(nn.Module):
 
-    def __init__(self, in_ch, out_ch, kernel_size=3, stride=1, padding=1, groups=1, dilation=1, act=True, bias=False):
+    def __init__(self, in_ch, out_ch, kernel_size=3, stride=1, padding=1, groups=1, dilation=1, act=True, bias=False,
+                 norm_groups=2):
 
         super().__init__()
         self.conv = nn.Conv3d(in_channels=in_ch, out_channels=out_ch, kernel_size=kernel_size, stride=stride, padding=padding, groups=groups, dilation=dilation, bias=bias)
-        self.norm = nn.GroupNorm(num_groups=2, num_channels=out_ch)
-        self.act = nn.ReLU() if act else nn.Identity()
+        self.norm = nn.GroupNorm(num_groups=norm_groups, num_channels=out_ch)
+        # GroupNorm 的反向只用到它的输入，ReLU 可以直接写回 norm 的输出，省掉一次整张量的分配和写入
+        self.act = nn.ReLU(inplace=True) if act else nn.Identity()
 
     def forward(self, x):
         out = self.act(self.norm(self.conv(x)))
@@ -25,61 +30,78 @@ class ConvNormAct(nn.Module):
 
 
 class BasicBlock(nn.Module):
-    def __init__(self, in_ch, out_ch, kernel_size=[3, 3, 3], stride=2, norm=nn.BatchNorm3d):
+    # groups > 1 packs that many independent blocks along the channel dim (one per modality)
+    def __init__(self, in_ch, out_ch, kernel_size=[3, 3, 3], stride=2, norm=nn.BatchNorm3d, groups=1):
         super().__init__()
 
         pad_size = [i//2 for i in kernel_size]
-
-        self.conv1 = ConvNormAct(in_ch, out_ch, kernel_size, stride=stride, padding=pad_size, )
-        self.conv2 = ConvNormAct(out_ch, out_ch, kernel_size, stride=1, padding=pad_size)
-        self.residual = ConvNormAct(in_ch, out_ch, kernel_size, stride=stride, padding=pad_size)
+        self.groups = groups
+
+        # conv1 和 residual 的输入、卷积核与步长都相同，合并成一个卷积；GroupNorm 的组按通道连续划分，
+        # 每个 group 的 4 个 norm 组中前 2 组属于 conv1、后 2 组属于 residual，与各自单独做 2 组 GroupNorm 等价
+        self.conv1_residual = ConvNormAct(in_ch, 2 * out_ch, kernel_size, stride=stride, padding=pad_size,
+                                          groups=groups, norm_groups=4 * groups)
+        self.conv2 = ConvNormAct(out_ch, out_ch, kernel_size, stride=1, padding=pad_size, groups=groups,
+                                 norm_groups=2 * groups)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中 conv1 和 residual 是两个 ConvNormAct，按 group 交错拼成 conv1_residual 的参数
+        for key in [k for k in state_dict if k.startswith(prefix + 'conv1.')]:
+            name = key[len(prefix + 'conv1.'):]
+            conv1, residual = state_dict.pop(key), state_dict.pop(prefix + 'residual.' + name)
+            state_dict[prefix + 'conv1_residual.' + name] = torch.stack(
+                [conv1.unflatten(0, (self.groups, -1)), residual.unflatten(0, (self.groups, -1))], dim=1).flatten(0, 2)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        shortcut = x
-        x = self.conv1(x)
-        x = self.conv2(x)
-        x = x + self.residual(shortcut)
+        # 输出通道按 group 排列为 (groups, [conv1, residual], out_ch // groups)
+        x, shortcut = self.conv1_residual(x).unflatten(1, (self.groups, 2, -1)).unbind(2)
+        x = self.conv2(x.flatten(1, 2))
+        x = (x.unflatten(1, (self.groups, -1)) + shortcut).flatten(1, 2)
         return x
 
 
 class Conv_Stem(nn.Module):
-    def __init__(self, in_ch, out_ch, kernel_size=[3, 3, 3]):
+    def __init__(self, in_ch, out_ch, kernel_size=[3, 3, 3], groups=1):
         super().__init__()
 
         pad_size = [i // 2 for i in kernel_size]
 
-        self.conv1 = BasicBlock(in_ch, out_ch // 2, kernel_size=kernel_size)
-        self.conv2 = nn.Conv3d(out_ch // 2, out_ch, kernel_size=kernel_size, stride=2, padding=pad_size, bias=False)
+        self.conv1 = BasicBlock(in_ch, out_ch // 2, kernel_size=kernel_size, groups=groups)
+        self.conv2 = nn.Conv3d(out_ch // 2, out_ch, kernel_size=kernel_size, stride=2, padding=pad_size, bias=False,
+                               groups=groups)
 
     def forward(self, x):
         x_2 = self.conv1(x)
         x = self.conv2(x_2)
-        return x
-
-
-class Flatten(nn.Module):
-    def forward(self, x):
-        return x.view(x.size(0), -1)
+        return x_2, x
 
 
 class CCA(nn.Module):  # channel cross attention
     def __init__(self, F_g, F_x):  # f_g是全局的特征通道数,f_x是输入x的特征通道数
         super().__init__()
-        self.mlp_x = nn.Sequential(
-            Flatten(),
-            nn.Linear(F_x, F_x))
-        self.mlp_g = nn.Sequential(
-            Flatten(),
-            nn.Linear(F_g, F_x))
+        # 作用在池化后 (B, C, 1, 1, 1) 张量上的 1x1 卷积，等价于 Flatten + Linear，输出可直接与 x 广播
+        self.mlp_x = nn.Conv3d(F_x, F_x, kernel_size=1)
+        self.mlp_g = nn.Conv3d(F_g, F_x, kernel_size=1)
         self.relu = nn.ReLU(inplace=True)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中是 Sequential(Flatten, Linear)：mlp_x.1.weight (out, in) -> mlp_x.weight (out, in, 1, 1, 1)
+        for name in ('mlp_x', 'mlp_g'):
+            for p in ('weight', 'bias'):
+                key = prefix + name + '.1.' + p
+                if key in state_dict:
+                    t = state_dict.pop(key)
+                    state_dict[prefix + name + '.' + p] = t[..., None, None, None] if p == 'weight' else t
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, g, x):
         avg_pool_x = F.avg_pool3d(x, (x.size(2), x.size(3), x.size(4)), stride=(x.size(2), x.size(3), x.size(4)))
         channel_att_x = self.mlp_x(avg_pool_x)
         avg_pool_g = F.avg_pool3d(g, (g.size(2), g.size(3), g.size(4)), stride=(g.size(2), g.size(3), g.size(4)))
         channel_att_g = self.mlp_g(avg_pool_g)
         channel_att_sum = (channel_att_x + channel_att_g) / 2.0
-        scale = torch.sigmoid(channel_att_sum).unsqueeze(2).unsqueeze(3).unsqueeze(4).expand_as(x)
+        scale = torch.sigmoid(channel_att_sum)
         x_after_channel = x * scale
         out = self.relu(x_after_channel)
         return out
@@ -100,61 +122,61 @@ class CoordAtt(nn.Module):  # 三维坐标注意力，对应解码器TCFC部分
         self.conv2 = nn.Conv3d(inp, mip, kernel_size=1, stride=1, padding=0)
         self.bn2 = nn.BatchNorm3d(mip)
         self.relu2 = nn.ReLU()
-        #  conv_d, conv_h, conv_w 分别用于处理不同的坐标维度。
-        self.conv_d = nn.Conv3d(mip, oup, kernel_size=1, stride=1, padding=0)
-        self.conv_h = nn.Conv3d(mip, oup, kernel_size=1, stride=1, padding=0)
-        self.conv_w = nn.Conv3d(mip, oup, kernel_size=1, stride=1, padding=0)
+        #  conv_dhw 的三组输出通道分别对应原来的 conv_d, conv_h, conv_w，用于处理不同的坐标维度。
+        self.oup = oup
+        self.conv_dhw = nn.Conv3d(mip, 3 * oup, kernel_size=1, stride=1, padding=0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中的 conv_d, conv_h, conv_w 沿输出通道拼成 conv_dhw
+        _merge_old_keys(state_dict, prefix, ['conv_d.', 'conv_h.', 'conv_w.'], 'conv_dhw.', torch.cat)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def _coord_pool(t, d, h, w):
+        # 沿每个维度进行全局平均汇集，并将结果串联成 (b, c, d + h + w, 1, 1)
+        if t.shape[2:] == (d, h, w):
+            # 先在 w 上求一次平均，d 和 h 两个方向共用这个中间结果
+            t_dh = t.mean(4)
+            t_d, t_h, t_w = t_dh.mean(3), t_dh.mean(2), t.mean((2, 3))
+        else:
+            # g 与 x 尺寸不同时需要自适应池化
+            t_d = F.adaptive_avg_pool3d(t, (d, 1, 1)).flatten(2)
+            t_h = F.adaptive_avg_pool3d(t, (1, h, 1)).flatten(2)
+            t_w = F.adaptive_avg_pool3d(t, (1, 1, w)).flatten(2)
+        return torch.cat([t_d, t_h, t_w], dim=2)[..., None, None]
 
     def forward(self, g, x):
         b, c, d, h, w = x.size()
-        # 沿每个维度对 g 进行全局平均汇集
-        g_d = F.adaptive_avg_pool3d(g, (d, 1, 1))
-        # 计算 g 中每个深度切片（沿深度维度的二维平面）的平均值，并输出一个深度为 d，高度和宽度均为 1 的三维张量。
-        g_h = F.adaptive_avg_pool3d(g, (1, h, 1)).permute(0, 1, 3, 2, 4)
-        g_w = F.adaptive_avg_pool3d(g, (1, 1, w)).permute(0, 1, 4, 2, 3)
-        # 沿每个维度对 x 进行全局平均汇集
-        x_d = F.adaptive_avg_pool3d(x, (d, 1, 1))
-        x_h = F.adaptive_avg_pool3d(x, (1, h, 1)).permute(0, 1, 3, 2, 4)
-        x_w = F.adaptive_avg_pool3d(x, (1, 1, w)).permute(0, 1, 4, 2, 3)
-        # 沿每个维度将全局平均池化特征串联起来
-        g_y = torch.cat([g_d, g_h, g_w], dim=2)
+        # 沿每个维度对 g 和 x 进行全局平均汇集
+        g_y = self._coord_pool(g, d, h, w)
+        x_y = self._coord_pool(x, d, h, w)
+
         g_y = self.conv1(g_y)
         g_y = self.bn1(g_y)
         g_y = self.relu1(g_y)
 
-        x_y = torch.cat([x_d, x_h, x_w], dim=2)
         x_y = self.conv2(x_y)
         x_y = self.bn2(x_y)
         x_y = self.relu2(x_y)
-        # 将连接的特征拆分成不同的维度
-        g_d, g_h, g_w = torch.split(g_y, [d, h, w], dim=2)
-        g_h = g_h.permute(0, 1, 3, 2, 4)
-        g_w = g_w.permute(0, 1, 3, 4, 2)
-
-        x_d, x_h, x_w = torch.split(x_y, [d, h, w], dim=2)
-        x_h = x_h.permute(0, 1, 3, 2, 4)
-        x_w = x_w.permute(0, 1, 3, 4, 2)
-        # 计算注意力权重
-        a_d = (x_d + g_d) / 2
-        a_h = (x_h + g_h) / 2
-        a_w = (x_w + g_w) / 2
-
-        a_d, a_h, a_w = torch.sigmoid(self.conv_d(a_d)), torch.sigmoid(self.conv_h(a_h)), torch.sigmoid(
-            self.conv_w(a_w))
+        # 计算注意力权重：三个方向一次 1x1 卷积，每个方向取自己那组输出通道和对应的坐标段
+        a = torch.sigmoid(self.conv_dhw((x_y + g_y) / 2))  # b, 3*oup, d+h+w, 1, 1
+        a_d = a[:, :self.oup, :d]
+        a_h = a[:, self.oup:2 * self.oup, d:d + h].permute(0, 1, 3, 2, 4)
+        a_w = a[:, 2 * self.oup:, d + h:].permute(0, 1, 3, 4, 2)
 
         x = x * a_d * a_h * a_w
         return x
 
 
 class SEBlock(nn.Module):
-    def __init__(self, in_ch, ratio=4, act=nn.ReLU):
+    def __init__(self, in_ch, ratio=4, act=nn.ReLU, groups=1):
         super().__init__()
 
         self.squeeze = nn.AdaptiveAvgPool3d(1)
         self.excitation = nn.Sequential(
-            nn.Conv3d(in_ch, in_ch // ratio, kernel_size=1),
+            nn.Conv3d(in_ch, in_ch // ratio, kernel_size=1, groups=groups),
             act(),
-            nn.Conv3d(in_ch // ratio, in_ch, kernel_size=1),
+            nn.Conv3d(in_ch // ratio, in_ch, kernel_size=1, groups=groups),
             nn.Sigmoid()
         )
 
@@ -166,24 +188,31 @@ class SEBlock(nn.Module):
 
 
 class MBConv(nn.Module):
-    def __init__(self, in_ch, out_ch, expansion=4, kernel_size=3, stride=1, ratio=4, se=True):
+    # groups > 1 packs that many independent MBConvs along the channel dim (one per modality), each group keeps its
+    # own conv weights and its own pair of GroupNorm groups
+    def __init__(self, in_ch, out_ch, expansion=4, kernel_size=3, stride=1, ratio=4, se=True, groups=1):
         super().__init__()
 
         padding = (kernel_size - 1) // 2
         expanded = expansion * in_ch
         self.se = se
 
-        self.expand_proj = nn.Identity() if (expansion == 1) else ConvNormAct(in_ch, expanded, kernel_size=1, padding=0)
+        self.expand_proj = nn.Identity() if (expansion == 1) else ConvNormAct(in_ch, expanded, kernel_size=1, padding=0,
+                                                                              groups=groups, norm_groups=2 * groups)
         self.depthwise = ConvNormAct(expanded, expanded, kernel_size=kernel_size, stride=stride, padding=padding,
-                                     groups=expanded)
+                                     groups=expanded, norm_groups=2 * groups)
 
         if self.se:
-            self.se = SEBlock(expanded, ratio=ratio)
+            self.se = SEBlock(expanded, ratio=ratio, groups=groups)
 
-        self.pointwise = ConvNormAct(expanded, out_ch, kernel_size=1, padding=0, act=False)
+        self.pointwise = ConvNormAct(expanded, out_ch, kernel_size=1, padding=0, act=False, groups=groups,
+                                     norm_groups=2 * groups)
+        self.to(memory_format=torch.channels_last_3d)
 
     def forward(self, x):
-        x = x.permute(0, 4, 1, 2, 3)
+        # b d h w c -> b c d h w is only a stride change: the view is channels_last_3d, which the convs consume as is,
+        # and their channels_last_3d output permutes back to a contiguous b d h w c tensor
+        x = x.permute(0, 4, 1, 2, 3).contiguous(memory_format=torch.channels_last_3d)
         x = self.expand_proj(x)
         x = self.depthwise(x)
         if self.se:
@@ -212,12 +241,82 @@ class Mlp(nn.Module):
         return x
 
 
+class GroupedLinear(nn.Module):
+    # `groups` independent nn.Linear layers applied as one batched GEMM, x: (groups, ..., in_features)
+    def __init__(self, in_features, out_features, groups=1, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.groups = groups
+        self.weight = nn.Parameter(torch.empty(groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(groups, out_features)) if bias else None
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same distribution as the default nn.Linear init
+        bound = 1 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        if self.bias is not None:
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(self.groups, -1, self.in_features)
+        if self.bias is None:
+            x = torch.bmm(x, self.weight.transpose(1, 2))
+        else:
+            x = torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+        return x.view(*shape[:-1], self.out_features)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _add_group_dim(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class GroupedLayerNorm(nn.Module):
+    # `groups` independent nn.LayerNorm(dim) applied in one call, x: (groups, ..., dim)
+    def __init__(self, dim, groups=1, eps=1e-5):
+        super().__init__()
+        self.dim = dim
+        self.groups = groups
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(groups, dim))
+        self.bias = nn.Parameter(torch.zeros(groups, dim))
+
+    def forward(self, x):
+        shape = (self.groups,) + (1,) * (x.dim() - 2) + (self.dim,)
+        x = F.layer_norm(x, (self.dim,), eps=self.eps)
+        return torch.addcmul(self.bias.view(shape), x, self.weight.view(shape))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _add_group_dim(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def _merge_old_keys(state_dict, prefix, old_prefixes, new_prefix, merge):
+    # 兼容按模态分开的旧 checkpoint：old_prefixes 下同名的参数用 merge（torch.stack / torch.cat）合成 new_prefix 下的参数。
+    # 父模块加载时先改写 state_dict，子模块随后按新的键名加载
+    first = prefix + old_prefixes[0]
+    for key in [k for k in state_dict if k.startswith(first)]:
+        name = key[len(first):]
+        state_dict[prefix + new_prefix + name] = merge([state_dict.pop(prefix + p + name) for p in old_prefixes])
+
+
+def _add_group_dim(module, state_dict, prefix):
+    # 没有 group 维的旧参数（nn.Linear / nn.LayerNorm，或沿第 0 维拼接的各模态参数）按 group 优先的顺序 reshape
+    for name, param in module.named_parameters(recurse=False):
+        t = state_dict.get(prefix + name)
+        if t is not None and t.dim() < param.dim() and t.numel() == param.numel():
+            state_dict[prefix + name] = t.reshape(param.shape)
+
+
 def window_partition(x, window_size):
     # 在输入张量的每个维度上进行划窗操作，产生了一个新的张量windows，其中包含了按窗口大小切割后的子张量。
+    # permute 之后直接 reshape，只拷贝一次
     B, D, H, W, C = x.shape
     x = x.view(B, D // window_size[0], window_size[0], H // window_size[1], window_size[1], W // window_size[2],
                window_size[2], C)
-    windows = x.permute(0, 1, 3, 5, 2, 4, 6, 7).contiguous().view(-1, reduce(mul, window_size), C)
+    windows = x.permute(0, 1, 3, 5, 2, 4, 6, 7).reshape(-1, reduce(mul, window_size), C)
     # (batch_size * depth_windows * height_windows * width_windows, window_size[0] * window_size[1] * window_size[2], channels)
     return windows
 
@@ -226,169 +325,236 @@ def window_reverse(windows, window_size, B, D, H, W):
     # 划窗操作的逆过程，用于将划窗得到的张量 windows 还原回原始形状。
     x = windows.view(B, D // window_size[0], H // window_size[1], W // window_size[2], window_size[0], window_size[1],
                      window_size[2], -1)
-    x = x.permute(0, 1, 4, 2, 5, 3, 6, 7).contiguous().view(B, D, H, W, -1)
+    x = x.permute(0, 1, 4, 2, 5, 3, 6, 7).reshape(B, D, H, W, -1)
     return x
 
 
 def get_window_size(x_size, window_size, shift_size=None):
     # 计算最终使用的windows大小和步幅。
     # 确保在划窗操作中使用的窗口大小和步幅不会导致超出输入张量的边界。
-    use_window_size = list(window_size)
-    if shift_size is not None:
-        use_shift_size = list(shift_size)
-    for i in range(len(x_size)):
-        # 如果输入尺寸小于等于窗口尺寸，使用输入尺寸，并将步幅设为0
-        if x_size[i] <= window_size[i]:
-            use_window_size[i] = x_size[i]
-            if shift_size is not None:
-                use_shift_size[i] = 0
+    # 结果只取决于这几个小元组，每个 block 每次前向都会调用，转成元组后走缓存
+    return _get_window_size(tuple(x_size), tuple(window_size), None if shift_size is None else tuple(shift_size))
+
 
+@lru_cache(maxsize=64)
+def _get_window_size(x_size, window_size, shift_size):
+    # 如果输入尺寸小于等于窗口尺寸，使用输入尺寸，并将步幅设为0
+    use_window_size = tuple(min(x, w) for x, w in zip(x_size, window_size))
     if shift_size is None:
-        return tuple(use_window_size)
+        return use_window_size
+    use_shift_size = tuple(0 if x <= w else s for x, w, s in zip(x_size, window_size, shift_size))
+    return use_window_size, use_shift_size
+
+
+def window_msa(x, window_size, shift_size, mask_matrix, attn_fn):
+    # W-MSA / SW-MSA 的公共部分：pad -> cyclic shift -> 划窗 -> attn_fn -> 合并窗口 -> 反向 shift -> 去掉 pad
+    # x: N, D, H, W, C；shift_size 为 None（或实际移位全为 0）时不 roll，也不使用 mask
+    # attn_fn(x_windows, mask): N*nW, Wd*Wh*Ww, C -> N*nW, Wd*Wh*Ww, C
+    N, D, H, W, C = x.shape
+    if shift_size is None:
+        window_size, shift_size = get_window_size((D, H, W), window_size), (0, 0, 0)
     else:
-        return tuple(use_window_size), tuple(use_shift_size)
+        window_size, shift_size = get_window_size((D, H, W), window_size, shift_size)
+    shifted = any(i > 0 for i in shift_size)
+
+    # pad feature maps to multiples of window size
+    pad_l = pad_t = pad_d0 = 0
+    pad_d1 = (window_size[0] - D % window_size[0]) % window_size[0]
+    pad_b = (window_size[1] - H % window_size[1]) % window_size[1]
+    pad_r = (window_size[2] - W % window_size[2]) % window_size[2]
+    x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
+    _, Dp, Hp, Wp, _ = x.shape
+    # cyclic shift
+    if shifted:
+        x = torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
+    # partition windows
+    x_windows = window_partition(x, window_size)  # N*nW, Wd*Wh*Ww, C
+    attn_windows = attn_fn(x_windows, mask_matrix if shifted else None)
+    # merge windows
+    attn_windows = attn_windows.view(-1, *(window_size + (C,)))
+    x = window_reverse(attn_windows, window_size, N, Dp, Hp, Wp)  # N, Dp, Hp, Wp, C
+    # reverse cyclic shift
+    if shifted:
+        x = torch.roll(x, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
+
+    if pad_d1 > 0 or pad_r > 0 or pad_b > 0:
+        x = x[:, :D, :H, :W, :]
+    return x
+
+
+def _rel_pos_index(window_size):
+    # 每次返回新的张量：注册为 buffer 后 load_state_dict 会原地写入，不能与缓存中的张量共享存储
+    return _rel_pos_index_cached(window_size).clone()
+
+
+@lru_cache(maxsize=16)
+def _rel_pos_index_cached(window_size):
+    # 窗口内两两 token 的相对坐标，平移到从 0 开始后展平成偏置表的行号: Wd*Wh*Ww, Wd*Wh*Ww
+    coords = torch.cartesian_prod(*[torch.arange(i) for i in window_size])  # Wd*Wh*Ww, 3
+    relative_coords = coords[:, None, :] - coords[None, :, :] + torch.tensor(window_size) - 1
+    strides = torch.tensor([(2 * window_size[1] - 1) * (2 * window_size[2] - 1), 2 * window_size[2] - 1, 1])
+    return (relative_coords * strides).sum(-1)
+
+
+def window_attention(q, k, v, relative_position_bias, mask=None, dropout_p=0., scale=None):
+    # mask 为 BlockMask 时走 flex_attention，见 Encoder 的 use_flex_attention
+    if flex_attention is not None and isinstance(mask, BlockMask):
+        return _flex_window_attention(q, k, v, relative_position_bias, mask, scale=scale)
+    # q, k, v: G, B_, nH, N, C; relative_position_bias: G, nH, N, N; mask: nW, N, N (bool, True 为屏蔽)
+    # 返回 G, B_, N, nH*C
+    # 相对位置偏置和移位窗口的 mask 合并成一个加性 mask，交给 scaled_dot_product_attention 一次算完
+    # 偏置先转换到 q 的 dtype，被屏蔽的位置直接填 -inf（autocast 下不会先在 fp32 中生成整个 nW 倍大小的 mask）
+    G, B_, nH, N, C = q.shape
+    nW = 1 if mask is None else mask.shape[0]
+    attn_mask = relative_position_bias.to(q.dtype).unsqueeze(1)  # G, 1, nH, N, N
+    if mask is not None:
+        attn_mask = torch.where(mask.unsqueeze(1), float('-inf'), attn_mask)  # G, nW, nH, N, N
+    # 融合的 SDPA kernel 只接受 4 维的 q/k/v：group、窗口和 head 一起并入 head 维，
+    # q/k/v 为 B, G*nW*nH, N, C，mask 为 1, G*nW*nH, N, N（在 batch 维上广播）
+    attn_mask = attn_mask.reshape(1, G * nW * nH, N, N)
+    q, k, v = [t.reshape(G, B_ // nW, nW, nH, N, C).transpose(0, 1).reshape(B_ // nW, G * nW * nH, N, C)
+               for t in (q, k, v)]
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, scale=scale)
+    return x.view(B_ // nW, G, nW, nH, N, C).permute(1, 0, 2, 4, 3, 5).reshape(G, B_, N, nH * C)
+
+
+def _flex_window_attention(q, k, v, relative_position_bias, block_mask, scale=None):
+    # 移位窗口的 mask 改为 flex_attention 的 block mask（跨区域的 token 对不再计算，整块被屏蔽的部分直接跳过），
+    # 相对位置偏置作为 score_mod；需要在 torch.compile 下运行才会生成融合的 kernel
+    G, B_, nH, N, C = q.shape
+    nW = block_mask.shape[0]
+    B = B_ // nW
+    bias = relative_position_bias.to(q.dtype)  # G, nH, N, N
+
+    # 窗口作为 batch 维：nW, G*B*nH, N, C，head 下标 h = (g * B + i) * nH + j，block mask 在 head 维上广播
+    def score_mod(score, b, h, q_idx, kv_idx):
+        return score + bias[h // (B * nH), h % nH, q_idx, kv_idx]
+
+    q, k, v = [t.reshape(G, B, nW, nH, N, C).permute(2, 0, 1, 3, 4, 5).reshape(nW, G * B * nH, N, C)
+               for t in (q, k, v)]
+    x = flex_attention(q, k, v, score_mod=score_mod, block_mask=block_mask, scale=scale)
+    return x.view(nW, G, B, nH, N, C).permute(1, 2, 0, 4, 3, 5).reshape(G, B_, N, nH * C)
+
+
+@lru_cache()
+def _flex_block_mask(mask):
+    # block mask 只与移位窗口的 mask（本身按尺寸和 device 缓存）有关，每个 mask 只构建一次
+    nW, N, _ = mask.shape
+    allowed = ~mask
+
+    def mask_mod(b, h, q_idx, kv_idx):
+        return allowed[b, q_idx, kv_idx]
+
+    return create_block_mask(mask_mod, B=nW, H=None, Q_LEN=N, KV_LEN=N, device=mask.device)
 
 
-class CrossWindowAttention3D(nn.Module):
-    def __init__(self, dim, window_size, num_heads, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+class WindowAttention3DBase(nn.Module):
+    # 窗口注意力共用的部分：每个 group 一张相对位置偏置表和按窗口大小计算的相对位置索引
+    def __init__(self, dim, window_size, num_heads, qk_scale=None, groups=1):
         super().__init__()
         self.dim = dim
         self.window_size = window_size  # Wd, Wh, Ww
         self.num_heads = num_heads
+        self.groups = groups
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
 
         self.relative_position_bias_table = nn.Parameter(
-            torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1) * (2 * window_size[2] - 1), num_heads))
-        # 相对位置偏置表，形状为:2*Wd-1 * 2*Wh-1 * 2*Ww-1, nH
-
-        # 构建相对位置索引和偏置表
-        coords_d = torch.arange(self.window_size[0])
-        coords_h = torch.arange(self.window_size[1])
-        coords_w = torch.arange(self.window_size[2])
-        coords = torch.stack(torch.meshgrid(coords_d, coords_h, coords_w))  # 3, Wd, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 3, Wd*Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 3, Wd*Wh*Ww, Wd*Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wd*Wh*Ww, Wd*Wh*Ww, 3
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 2] += self.window_size[2] - 1
-
-        relative_coords[:, :, 0] *= (2 * self.window_size[1] - 1) * (2 * self.window_size[2] - 1)
-        relative_coords[:, :, 1] *= (2 * self.window_size[2] - 1)
-        relative_position_index = relative_coords.sum(-1)  # Wd*Wh*Ww, Wd*Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
-        self.query = nn.Linear(dim, dim)
-        self.key = nn.Linear(dim, dim)
-        self.value = nn.Linear(dim, dim)
-        self.attn_drop = nn.Dropout(attn_drop)
-        self.proj = nn.Linear(dim, dim)
-        self.proj_drop = nn.Dropout(proj_drop)
+            torch.zeros(groups, (2 * window_size[0] - 1) * (2 * window_size[1] - 1) * (2 * window_size[2] - 1),
+                        num_heads))
+        # 相对位置偏置表，形状为:G, 2*Wd-1 * 2*Wh-1 * 2*Ww-1, nH
+
+        # 相对位置索引只与窗口大小有关，计算结果按窗口大小缓存，每个模块持有自己的一份拷贝
+        self.register_buffer("relative_position_index", _rel_pos_index(tuple(window_size)))
 
         # 相对位置偏置表的初始化
         trunc_normal_(self.relative_position_bias_table, std=.02)
-        self.softmax = nn.Softmax(dim=-1)
+        self._bias_cache = None
+
+    def _apply(self, fn, *args, **kwargs):
+        self._bias_cache = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint：偏置表没有 group 维；逐模态堆叠过来的相对位置索引都相同，取一份即可
+        _add_group_dim(self, state_dict, prefix)
+        index = state_dict.get(prefix + 'relative_position_index')
+        if index is not None and index.dim() == 3:
+            state_dict[prefix + 'relative_position_index'] = index[0]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_relative_position_bias(self, N):
+        # G, nH, N, N. 无梯度时（推理）偏置只随偏置表变化，按偏置表的版本号缓存，避免每次前向都重新 gather；
+        # torch.compile 下不走缓存（_version 无法作为 guard，会打断图），gather 直接编译进图里
+        caching = not (torch.is_grad_enabled() or torch.compiler.is_compiling())
+        key = (N, self.relative_position_bias_table._version) if caching else None
+        if not caching or self._bias_cache is None or self._bias_cache[0] != key:
+            relative_position_bias = self.relative_position_bias_table[
+                :, self.relative_position_index[:N, :N].reshape(-1)].reshape(self.groups, N, N, -1)
+            # G,Wd*Wh*Ww,Wd*Wh*Ww,nH -> G, nH, Wd*Wh*Ww, Wd*Wh*Ww
+            relative_position_bias = relative_position_bias.permute(0, 3, 1, 2).contiguous()
+            if not caching:
+                return relative_position_bias
+            self._bias_cache = (key, relative_position_bias)
+        return self._bias_cache[1]
+
+
+class CrossWindowAttention3D(WindowAttention3DBase):
+    # groups > 1 holds that many independent attention modules that run as one batched call, x/y: (groups, B_, N, C)
+    def __init__(self, dim, window_size, num_heads, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 groups=1):
+        super().__init__(dim, window_size, num_heads, qk_scale=qk_scale, groups=groups)
+        self.query = GroupedLinear(dim, dim, groups)
+        # key 和 value 都由 y 投影得到，合并成一次 GEMM
+        self.kv = GroupedLinear(dim, dim * 2, groups, bias=qkv_bias)
+        self.attn_drop = nn.Dropout(attn_drop)
+        self.proj = GroupedLinear(dim, dim, groups)
+        self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x, y, mask=None):
-        B_, N, C = x.shape
-        q, k, v = self.query(x).reshape(B_, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3), self.key(
-            y).reshape(B_, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3), self.value(y).reshape(B_, N,
-                                                                                                              self.num_heads,
-                                                                                                              C // self.num_heads).permute(
-            0, 2, 1, 3)
-        q = q * self.scale
-        attn = q @ k.transpose(-2, -1)
-
-        relative_position_bias = self.relative_position_bias_table[
-            self.relative_position_index[:N, :N].reshape(-1)].reshape(
-            N, N, -1)  # Wd*Wh*Ww,Wd*Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wd*Wh*Ww, Wd*Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)  # B_, nH, N, N
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中分开的 key / value 沿输出维拼成 kv
+        for p, dim in (('weight', -2), ('bias', -1)):
+            if prefix + 'key.' + p in state_dict:
+                state_dict[prefix + 'kv.' + p] = torch.cat(
+                    [state_dict.pop(prefix + 'key.' + p), state_dict.pop(prefix + 'value.' + p)], dim=dim)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        attn = self.attn_drop(attn)
+    def forward(self, x, y, mask=None):
+        G, B_, N, C = x.shape
+        q = self.query(x).reshape(G, B_, N, self.num_heads, C // self.num_heads).permute(0, 1, 3, 2, 4)
+        kv = self.kv(y).reshape(G, B_, N, 2, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)
+        k, v = kv[0], kv[1]  # G, B_, nH, N, C
 
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(q, k, v, self.get_relative_position_bias(N), mask,
+                             dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
         x = self.proj(x)
         x = self.proj_drop(x)
 
         return x
 
 
-class SelfWindowAttention3D(nn.Module):
+class SelfWindowAttention3D(WindowAttention3DBase):
+    # groups > 1 holds that many independent attention modules that run as one batched call, x: (groups, B_, N, C)
+    def __init__(self, dim, window_size, num_heads, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 groups=1):
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
-
-        super().__init__()
-        self.dim = dim
-        self.window_size = window_size  # Wd, Wh, Ww
-        self.num_heads = num_heads
-        head_dim = dim // num_heads
-        self.scale = qk_scale or head_dim ** -0.5
-
-        self.relative_position_bias_table = nn.Parameter(
-            torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1) * (2 * window_size[2] - 1), num_heads))
-        # 2*Wd-1 * 2*Wh-1 * 2*Ww-1, nH
-
-        coords_d = torch.arange(self.window_size[0])
-        coords_h = torch.arange(self.window_size[1])
-        coords_w = torch.arange(self.window_size[2])
-        coords = torch.stack(torch.meshgrid(coords_d, coords_h, coords_w))  # 3, Wd, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 3, Wd*Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 3, Wd*Wh*Ww, Wd*Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wd*Wh*Ww, Wd*Wh*Ww, 3
-        relative_coords[:, :, 0] += self.window_size[0] - 1
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 2] += self.window_size[2] - 1
-
-        relative_coords[:, :, 0] *= (2 * self.window_size[1] - 1) * (2 * self.window_size[2] - 1)
-        relative_coords[:, :, 1] *= (2 * self.window_size[2] - 1)
-        relative_position_index = relative_coords.sum(-1)  # Wd*Wh*Ww, Wd*Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        super().__init__(dim, window_size, num_heads, qk_scale=qk_scale, groups=groups)
         self.num_attention_heads = num_heads
         self.attention_head_size = int(dim / num_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
-        self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
+        self.qkv = GroupedLinear(dim, dim * 3, groups, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
-        self.proj = nn.Linear(dim, dim)
+        self.proj = GroupedLinear(dim, dim, groups)
         self.proj_drop = nn.Dropout(proj_drop)
 
-        trunc_normal_(self.relative_position_bias_table, std=.02)
-        self.softmax = nn.Softmax(dim=-1)
-
     def forward(self, x, mask=None):
 
-        B_, N, C = x.shape
-        qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        q, k, v = qkv[0], qkv[1], qkv[2]  # B_, nH, N, C
-
-        q = q * self.scale
-        attn = q @ k.transpose(-2, -1)
-
-        relative_position_bias = self.relative_position_bias_table[
-            self.relative_position_index[:N, :N].reshape(-1)].reshape(N, N, -1)
-        # Wd*Wh*Ww,Wd*Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wd*Wh*Ww, Wd*Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)  # B_, nH, N, N
+        G, B_, N, C = x.shape
+        qkv = self.qkv(x).reshape(G, B_, N, 3, self.num_heads, C // self.num_heads).permute(3, 0, 1, 4, 2, 5)
+        q, k, v = qkv[0], qkv[1], qkv[2]  # G, B_, nH, N, C
 
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(q, k, v, self.get_relative_position_bias(N), mask,
+                             dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -400,36 +566,46 @@ class PositionalEncoding3D(nn.Module):
     def __init__(self, channels):
         super(PositionalEncoding3D, self).__init__()
         # 确保通道数是偶数
-        channels = int(np.ceil(channels / 6) * 2)  # ceil向上取整
+        channels = (channels + 5) // 6 * 2  # ceil向上取整
         if channels % 2:
             channels += 1
         self.channels = channels
         # 频率递减的序列，用于后续的正弦和余弦函数计算
         inv_freq = 1. / (10000 ** (torch.arange(0, channels, 2).float() / channels))
         self.register_buffer('inv_freq', inv_freq)
+        # 位置编码只依赖 (x, y, z)，按尺寸、dtype 和 device 缓存
+        self.cached_penc = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        self.cached_penc = {}
+        return super()._apply(fn, *args, **kwargs)
 
     def forward(self, tensor):
         if len(tensor.shape) != 5:
             raise RuntimeError("The input tensor has to be 5d!")
         batch_size, x, y, z, orig_ch = tensor.shape
-        # 使用正弦和余弦函数，计算了三个方向上的位置编码
-        pos_x = torch.arange(x, device=tensor.device).type(self.inv_freq.type())
-        pos_y = torch.arange(y, device=tensor.device).type(self.inv_freq.type())
-        pos_z = torch.arange(z, device=tensor.device).type(self.inv_freq.type())
-        sin_inp_x = torch.einsum("i,j->ij", pos_x, self.inv_freq)
-        sin_inp_y = torch.einsum("i,j->ij", pos_y, self.inv_freq)
-        sin_inp_z = torch.einsum("i,j->ij", pos_z, self.inv_freq)
-        # 将正弦和余弦函数的结果拼接成新的张量
-        emb_x = torch.cat((sin_inp_x.sin(), sin_inp_x.cos()), dim=-1).unsqueeze(1).unsqueeze(1)
-        emb_y = torch.cat((sin_inp_y.sin(), sin_inp_y.cos()), dim=-1).unsqueeze(1)
-        emb_z = torch.cat((sin_inp_z.sin(), sin_inp_z.cos()), dim=-1)
-        # 创建一个全零的张量emb，将计算得到的位置编码张量填充到其中。
-        emb = torch.zeros((x, y, z, self.channels * 3), device=tensor.device).type(tensor.type())
-        emb[:, :, :, :self.channels] = emb_x
-        emb[:, :, :, self.channels:2 * self.channels] = emb_y
-        emb[:, :, :, 2 * self.channels:] = emb_z
-        # 将计算得到的位置编码张量重复扩展到 batch 维度上，并将通道数调整为 orig_ch。这个位置编码张量将会和输入张量相加，以提供相对位置信息。
-        return emb[None, :, :, :, :orig_ch].repeat(batch_size, 1, 1, 1, 1)
+        key = (x, y, z, tensor.dtype, tensor.device)
+        if key not in self.cached_penc:
+            self.cached_penc[key] = self._build(x, y, z, tensor.device).type(tensor.type())
+        # 将位置编码沿 batch 维 expand（不拷贝），并将通道数调整为 orig_ch。这个位置编码张量将会和输入张量相加，以提供相对位置信息。
+        return self.cached_penc[key][None, :, :, :, :orig_ch].expand(batch_size, -1, -1, -1, -1)
+
+    @torch.autocast('cuda', enabled=False)
+    @torch.autocast('cpu', enabled=False)
+    def _build(self, x, y, z, device):
+        # 使用正弦和余弦函数，计算了三个方向上的位置编码；在 fp32 下计算（autocast 关闭），最后再转换到输入的 dtype
+        pos_x = torch.arange(x, device=device).type(self.inv_freq.type())
+        pos_y = torch.arange(y, device=device).type(self.inv_freq.type())
+        pos_z = torch.arange(z, device=device).type(self.inv_freq.type())
+        # 外积直接用广播计算
+        sin_inp_x = pos_x[:, None] * self.inv_freq[None, :]
+        sin_inp_y = pos_y[:, None] * self.inv_freq[None, :]
+        sin_inp_z = pos_z[:, None] * self.inv_freq[None, :]
+        # 将正弦和余弦函数的结果拼接后 expand 到 (x, y, z)，再沿通道拼接，输出只分配一次
+        emb_x = torch.cat((sin_inp_x.sin(), sin_inp_x.cos()), dim=-1)[:, None, None, :].expand(x, y, z, -1)
+        emb_y = torch.cat((sin_inp_y.sin(), sin_inp_y.cos()), dim=-1)[None, :, None, :].expand(x, y, z, -1)
+        emb_z = torch.cat((sin_inp_z.sin(), sin_inp_z.cos()), dim=-1)[None, None, :, :].expand(x, y, z, -1)
+        return torch.cat([emb_x, emb_y, emb_z], dim=-1)
 
 
 class SwinTransformerBlock3D(nn.Module):
@@ -448,118 +624,60 @@ class SwinTransformerBlock3D(nn.Module):
         assert 0 <= self.shift_size[1] < self.window_size[1], "shift_size must in 0-window_size"
         assert 0 <= self.shift_size[2] < self.window_size[2], "shift_size must in 0-window_size"
 
-        self.norm_t1_1 = norm_layer(dim)
-        self.norm_t1ce_1 = norm_layer(dim)
-        self.norm_t2_1 = norm_layer(dim)
-        self.norm_flair_1 = norm_layer(dim)
-        self.self_attn_t1 = SelfWindowAttention3D(
+        # one LayerNorm per modality (t1, t1ce, t2, flair)
+        self.norm1 = GroupedLayerNorm(dim, groups=4)
+        # one group per modality (t1, t1ce, t2, flair)
+        self.self_attn = SelfWindowAttention3D(
             dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.self_attn_t1ce = SelfWindowAttention3D(
-            dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.self_attn_t2 = SelfWindowAttention3D(
-            dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.self_attn_flair = SelfWindowAttention3D(
-            dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.cross_attn_1 = CrossWindowAttention3D(
-            dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.cross_attn_2 = CrossWindowAttention3D(
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, groups=4)
+        # group 0 is shared by (t1, t1ce), group 1 by (t2, flair)
+        self.cross_attn = CrossWindowAttention3D(
             dim, window_size=self.window_size, num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, groups=2)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
-        self.norm_t1_2 = norm_layer(dim)
-        self.norm_t1ce_2 = norm_layer(dim)
-        self.norm_t2_2 = norm_layer(dim)
-        self.norm_flair_2 = norm_layer(dim)
-        self.mlp_t1 = MBConv(in_ch=dim, out_ch=dim)
-        self.mlp_t1ce = MBConv(in_ch=dim, out_ch=dim)
-        self.mlp_t2 = MBConv(in_ch=dim, out_ch=dim)
-        self.mlp_flair = MBConv(in_ch=dim, out_ch=dim)
+        self.norm2 = GroupedLayerNorm(dim, groups=4)
+        self.mlp = MBConv(in_ch=dim * 4, out_ch=dim * 4, groups=4)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中每个模态各有一套 norm / self_attn / mlp，(t1, t1ce) 和 (t2, flair) 各一个 cross_attn：
+        # LayerNorm 和注意力按 group 堆叠，MBConv 的卷积沿输出通道拼接
+        modalities = ('t1', 't1ce', 't2', 'flair')
+        for i in ('1', '2'):
+            _merge_old_keys(state_dict, prefix, ['norm_%s_%s.' % (m, i) for m in modalities], 'norm%s.' % i,
+                            torch.stack)
+        _merge_old_keys(state_dict, prefix, ['self_attn_%s.' % m for m in modalities], 'self_attn.', torch.stack)
+        _merge_old_keys(state_dict, prefix, ['cross_attn_1.', 'cross_attn_2.'], 'cross_attn.', torch.stack)
+        _merge_old_keys(state_dict, prefix, ['mlp_%s.' % m for m in modalities], 'mlp.', torch.cat)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward_part1(self, t1, t1ce, t2, flair, mask_matrix, cross):
-        B, D, H, W, C = t1.shape
-        window_size, shift_size = get_window_size((D, H, W), self.window_size, self.shift_size)
-
-        t1, t1ce, t2, flair = self.norm_t1_1(t1), self.norm_t1ce_1(t1ce), self.norm_t2_1(t2), self.norm_flair_1(flair),
-        # pad feature maps to multiples of window size
-        pad_l = pad_t = pad_d0 = 0
-        pad_d1 = (window_size[0] - D % window_size[0]) % window_size[0]
-        pad_b = (window_size[1] - H % window_size[1]) % window_size[1]
-        pad_r = (window_size[2] - W % window_size[2]) % window_size[2]
-        t1 = F.pad(t1, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        t1ce = F.pad(t1ce, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        t2 = F.pad(t2, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        flair = F.pad(flair, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        _, Dp, Hp, Wp, _ = t1.shape
-        # cyclic shift
-        if any(i > 0 for i in shift_size):
-            shifted_t1 = torch.roll(t1, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            shifted_t1ce = torch.roll(t1ce, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            shifted_t2 = torch.roll(t2, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            shifted_flair = torch.roll(flair, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            attn_mask = mask_matrix
-        else:
-            shifted_t1 = t1
-            shifted_t1ce = t1ce
-            shifted_t2 = t2
-            shifted_flair = flair
-            attn_mask = None
-        # partition windows
-        t1_windows = window_partition(shifted_t1, window_size)  # B*nW, Wd*Wh*Ww, C
-        t1ce_windows = window_partition(shifted_t1ce, window_size)
-        t2_windows = window_partition(shifted_t2, window_size)
-        flair_windows = window_partition(shifted_flair, window_size)
-        # W-MSA/SW-MSA
-        attn_windows_t1 = self.self_attn_t1(t1_windows, mask=attn_mask) if cross == False else self.self_attn_t1(
-            t1_windows, mask=attn_mask) + self.cross_attn_1(t1_windows, t1ce_windows, mask=attn_mask)
-        attn_windows_t1ce = self.self_attn_t1ce(t1ce_windows,
-                                                mask=attn_mask) if cross == False else self.self_attn_t1ce(t1ce_windows,
-                                                                                                           mask=attn_mask) + self.cross_attn_1(
-            t1ce_windows, t1_windows, mask=attn_mask)
-        attn_windows_t2 = self.self_attn_t2(t2_windows, mask=attn_mask) if cross == False else self.self_attn_t2(
-            t2_windows, mask=attn_mask) + self.cross_attn_2(t2_windows, flair_windows, mask=attn_mask)
-        attn_windows_flair = self.self_attn_flair(flair_windows,
-                                                  mask=attn_mask) if cross == False else self.self_attn_flair(
-            flair_windows, mask=attn_mask) + self.cross_attn_2(flair_windows, t2_windows, mask=attn_mask)
-        # merge windows
-        attn_windows_t1 = attn_windows_t1.view(-1, *(window_size + (C,)))
-        attn_windows_t1ce = attn_windows_t1ce.view(-1, *(window_size + (C,)))
-        attn_windows_t2 = attn_windows_t2.view(-1, *(window_size + (C,)))
-        attn_windows_flair = attn_windows_flair.view(-1, *(window_size + (C,)))
-        shifted_t1 = window_reverse(attn_windows_t1, window_size, B, Dp, Hp, Wp)
-        shifted_t1ce = window_reverse(attn_windows_t1ce, window_size, B, Dp, Hp, Wp)
-        shifted_t2 = window_reverse(attn_windows_t2, window_size, B, Dp, Hp, Wp)
-        shifted_flair = window_reverse(attn_windows_flair, window_size, B, Dp, Hp, Wp)
-        # reverse cyclic shift
-        if any(i > 0 for i in shift_size):
-            t1 = torch.roll(shifted_t1, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-            t1ce = torch.roll(shifted_t1ce, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-            t2 = torch.roll(shifted_t2, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-            flair = torch.roll(shifted_flair, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-        else:
-            t1 = shifted_t1
-            t1ce = shifted_t1ce
-            t2 = shifted_t2
-            flair = shifted_flair
-
-        if pad_d1 > 0 or pad_r > 0 or pad_b > 0:
-            t1 = t1[:, :D, :H, :W, :].contiguous()
-            t1ce = t1ce[:, :D, :H, :W, :].contiguous()
-            t2 = t2[:, :D, :H, :W, :].contiguous()
-            flair = flair[:, :D, :H, :W, :].contiguous()
+        B = t1.shape[0]
+        # all four modalities go through norm / pad / shift / window partition together
+        x = self.norm1(torch.stack([t1, t1ce, t2, flair], dim=0)).flatten(0, 1)  # 4*B, D, H, W, C
+
+        def attn_fn(x_windows, mask):
+            x_windows = x_windows.view(4, -1, *x_windows.shape[1:])  # 4, B*nW, Wd*Wh*Ww, C
+            # W-MSA/SW-MSA
+            attn_windows = self.self_attn(x_windows, mask=mask)
+            if cross:
+                # t1 <-> t1ce and t2 <-> flair attend to each other, the pairs share the weights of their group
+                y_windows = x_windows[[1, 0, 3, 2]]
+                attn_windows = attn_windows + self.cross_attn(x_windows.view(2, -1, *x_windows.shape[2:]),
+                                                              y_windows.view(2, -1, *y_windows.shape[2:]),
+                                                              mask=mask).view_as(attn_windows)
+            return attn_windows.flatten(0, 1)
+
+        x = window_msa(x, self.window_size, self.shift_size, mask_matrix, attn_fn)
+        t1, t1ce, t2, flair = x.view(4, B, *x.shape[1:]).unbind(0)
         return t1, t1ce, t2, flair
 
     def forward_part2(self, t1, t1ce, t2, flair):
-
-        t1 = self.drop_path(self.mlp_t1(self.norm_t1_2(t1)))
-        t1ce = self.drop_path(self.mlp_t1ce(self.norm_t1ce_2(t1ce)))
-        t2 = self.drop_path(self.mlp_t2(self.norm_t2_2(t2)))
-        flair = self.drop_path(self.mlp_flair(self.norm_flair_2(flair)))
+        # the grouped MBConv takes the modalities concatenated along channels
+        x = self.norm2(torch.stack([t1, t1ce, t2, flair], dim=0))  # 4, B, D, H, W, C
+        x = x.permute(1, 2, 3, 4, 0, 5).flatten(4)  # B, D, H, W, 4*C
+        t1, t1ce, t2, flair = self.mlp(x).chunk(4, dim=-1)
+        t1, t1ce, t2, flair = self.drop_path(t1), self.drop_path(t1ce), self.drop_path(t2), self.drop_path(flair)
         return t1, t1ce, t2, flair
 
     def forward(self, t1, t1ce, t2, flair, mask_matrix, cross):
@@ -601,42 +719,10 @@ class BottleneckBlock3D(nn.Module):
         self.mlp = MBConv(in_ch=dim, out_ch=dim)
 
     def forward_part1(self, x, mask_matrix, cross):
-        B, D, H, W, C = x.shape
-        window_size, shift_size = get_window_size((D, H, W), self.window_size, self.shift_size)
-
         x = self.norm_1(x)
-        # pad feature maps to multiples of window size
-        pad_l = pad_t = pad_d0 = 0
-        pad_d1 = (window_size[0] - D % window_size[0]) % window_size[0]
-        pad_b = (window_size[1] - H % window_size[1]) % window_size[1]
-        pad_r = (window_size[2] - W % window_size[2]) % window_size[2]
-        x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        _, Dp, Hp, Wp, _ = x.shape
-        # cyclic shift
-        if any(i > 0 for i in shift_size):
-            shifted_x = torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            attn_mask = mask_matrix
-        else:
-            shifted_x = x
-            attn_mask = None
-        # partition windows
-        x_windows = window_partition(shifted_x, window_size)  # B*nW, Wd*Wh*Ww, C
-
         # W-MSA/SW-MSA
-        attn_windows_x = self.self_attn_x(x_windows, mask=attn_mask)
-        # merge window
-        attn_windows_x = attn_windows_x.view(-1, *(window_size + (C,)))
-        shifted_x = window_reverse(attn_windows_x, window_size, B, Dp, Hp, Wp)  # B D' H' W' C=
-        # reverse cyclic shift
-        if any(i > 0 for i in shift_size):
-            x = torch.roll(shifted_x, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-
-        else:
-            x = shifted_x
-
-        if pad_d1 > 0 or pad_r > 0 or pad_b > 0:
-            x = x[:, :D, :H, :W, :].contiguous()
-
+        x = window_msa(x, self.window_size, self.shift_size, mask_matrix,
+                       lambda x_windows, mask: self.self_attn_x(x_windows.unsqueeze(0), mask=mask).squeeze(0))
         return x
 
     def forward_part2(self, x):
@@ -662,31 +748,59 @@ class PatchMerging(nn.Module):
         super().__init__()
         self.dim = dim
         self.reduction = nn.Conv3d(dim, dim * 2, kernel_size=3, stride=2, padding=1)
+        self.reduction.to(memory_format=torch.channels_last_3d)
 
         self.norm = norm_layer(dim)
 
     def forward(self, x):
         x = F.gelu(x)
         x = self.norm(x)
-        x = x.permute(0, 4, 1, 2, 3).contiguous()
+        # channels_last_3d views, see MBConv.forward
+        x = x.permute(0, 4, 1, 2, 3)
         x = self.reduction(x)
-        x = x.permute(0, 2, 3, 4, 1).contiguous()
+        x = x.permute(0, 2, 3, 4, 1)
         return x
 
 
-@lru_cache()
+def get_attn_mask(x_size, window_size, shift_size, device):
+    # (D, H, W) 尺寸的特征图在移位窗口注意力中使用的 mask（先补齐到窗口大小的整数倍）
+    window_size, shift_size = get_window_size(x_size, window_size, shift_size)
+    Dp, Hp, Wp = [(s + w - 1) // w * w for s, w in zip(x_size, window_size)]
+    return compute_mask(Dp, Hp, Wp, window_size, shift_size, device)
+
+
 def compute_mask(D, H, W, window_size, shift_size, device):
-    img_mask = torch.zeros((1, D, H, W, 1), device=device)  # 1 Dp Hp Wp 1
-    cnt = 0
-    for d in slice(-window_size[0]), slice(-window_size[0], -shift_size[0]), slice(-shift_size[0], None):
-        for h in slice(-window_size[1]), slice(-window_size[1], -shift_size[1]), slice(-shift_size[1], None):
-            for w in slice(-window_size[2]), slice(-window_size[2], -shift_size[2]), slice(-shift_size[2], None):
-                img_mask[:, d, h, w, :] = cnt
-                cnt += 1
+    # 掩码只与尺寸、窗口和平移有关：在 CPU 上只构建一次，每个 device 只拷贝一次
+    return _mask_to_device(D, H, W, tuple(window_size), tuple(shift_size), torch.device(device))
+
+
+@lru_cache()
+def _mask_to_device(D, H, W, window_size, shift_size, device):
+    attn_mask = _compute_mask_cpu(D, H, W, window_size, shift_size)
+    if device.type == 'cpu':
+        return attn_mask
+    # 源张量在锁页内存中且被缓存持有，可以异步拷贝
+    return attn_mask.to(device=device, non_blocking=True)
+
+
+@lru_cache()
+def _compute_mask_cpu(D, H, W, window_size, shift_size):
+    # 每个轴按 [:-ws], [-ws:-ss], [-ss:] 分成 0/1/2 三段（按同样顺序赋值，ss 为 0 时与原来的覆盖行为一致），
+    # 三个轴的段号组合成区域编号 9*d + 3*h + w，与逐个切片赋值 cnt 的结果相同
+    region = []
+    for n, ws, ss in zip((D, H, W), window_size, shift_size):
+        idx = torch.zeros(n)
+        idx[-ws:-ss] = 1
+        idx[-ss:] = 2
+        region.append(idx)
+    img_mask = region[0][:, None, None] * 9 + region[1][None, :, None] * 3 + region[2][None, None, :]
+    img_mask = img_mask[None, :, :, :, None]  # 1 Dp Hp Wp 1
     mask_windows = window_partition(img_mask, window_size)  # nW, ws[0]*ws[1]*ws[2], 1
     mask_windows = mask_windows.squeeze(-1)  # nW, ws[0]*ws[1]*ws[2]
-    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    # 区域编号不同的 token 对为 True（屏蔽），一次比较完成；bool 存储，使用时再填 -inf
+    attn_mask = mask_windows.unsqueeze(1) != mask_windows.unsqueeze(2)
+    if torch.cuda.is_available():
+        attn_mask = attn_mask.pin_memory()
     return attn_mask
 
 
@@ -712,57 +826,46 @@ class BasicLayer(nn.Module):
         if self.downsample is not None:
             self.downsample = downsample(dim=dim, norm_layer=norm_layer)
 
-    def forward(self, t1, t1ce, t2, flair, extract_feature):
-
-        B, C, D, H, W = t1.shape
-        window_size, shift_size = get_window_size((D, H, W), self.window_size, self.shift_size)
-        t1, t1ce, t2, flair = rearrange(t1, 'b c d h w -> b d h w c'), rearrange(t1ce,
-                                                                                 'b c d h w -> b d h w c'), rearrange(
-            t2, 'b c d h w -> b d h w c'), rearrange(flair, 'b c d h w -> b d h w c')
-
-        Dp = int(np.ceil(D / window_size[0])) * window_size[0]
-        Hp = int(np.ceil(H / window_size[1])) * window_size[1]
-        Wp = int(np.ceil(W / window_size[2])) * window_size[2]
-        attn_mask = compute_mask(Dp, Hp, Wp, window_size, shift_size, t1.device)
+    def forward(self, t1, t1ce, t2, flair, extract_feature, attn_mask=None):
+        # 输入输出都是 b d h w c；attn_mask 可以由调用方预先算好传入
+        B, D, H, W, C = t1.shape
+        if attn_mask is None:
+            attn_mask = get_attn_mask((D, H, W), self.window_size, self.shift_size, t1.device)
 
+        # 每个 block 直接接收四个模态，跨模态的配对 (t1, t1ce) / (t2, flair) 在 block 内的分组 cross attention 中完成
         for depth, blk in enumerate(self.blocks):
-            t1_t1ce = torch.cat((t1, t1ce), dim=1)
-            t1_t2 = torch.cat((t1, t2), dim=1)
-            t1_flair = torch.cat((t1, flair), dim=1)
-            extract_feature, t1_t1ce, t1_t2, t1_flair = blk(t1_t1ce, t1_t2, t1_flair, attn_mask,
-                                                            cross=True if depth == len(self.blocks) - 1 else False)
-        # for depth, blk in enumerate(self.blocks):
-        #     t1, t1ce, t2, flair = blk(t1, t1ce, t2, flair, attn_mask,
-        #                               cross=True if depth == len(self.blocks) - 1 else False)
-        extract_feature.append(torch.cat(
-            [rearrange(t1, 'b d h w c -> b c d h w'), rearrange(t1ce, 'b d h w c -> b c d h w'),
-             rearrange(t2, 'b d h w c -> b c d h w'), rearrange(flair, 'b d h w c -> b c d h w')], dim=1))
-        t1, t1ce, t2, flair = t1.reshape(B, D, H, W, -1), t1ce.reshape(B, D, H, W, -1), t2.reshape(B, D, H, W, -1), flair.reshape(B, D, H, W, -1)
+            t1, t1ce, t2, flair = blk(t1, t1ce, t2, flair, attn_mask,
+                                      cross=True if depth == len(self.blocks) - 1 else False)
+        # b c d h w 的特征图，以 channels_last_3d 的 permute 视图给出，不再拷贝
+        extract_feature.append(torch.cat([t1, t1ce, t2, flair], dim=-1).permute(0, 4, 1, 2, 3))
 
         if self.downsample is not None:
-            t1, t1ce, t2, flair = self.downsample(t1), self.downsample(t1ce), self.downsample(t2), self.downsample(
-                flair)
-        t1, t1ce, t2, flair = rearrange(t1, 'b d h w c -> b c d h w'), rearrange(t1ce,
-                                                                                 'b d h w c -> b c d h w'), rearrange(
-            t2, 'b d h w c -> b c d h w'), rearrange(flair, 'b d h w c -> b c d h w')
+            # 四个模态共用同一个 PatchMerging（GELU、LayerNorm、卷积都与 batch 无关），沿 batch 拼接后一次完成
+            t1, t1ce, t2, flair = self.downsample(torch.cat([t1, t1ce, t2, flair], dim=0)).chunk(4, dim=0)
 
         return extract_feature, t1, t1ce, t2, flair
 
 
 class PatchEmbed3D(nn.Module):
 
-    def __init__(self, img_size=(128, 128, 128), patch_size=(4, 4, 4), in_chans=1, embed_dim=64, norm_layer=None):
+    # groups > 1 embeds that many modalities at once: in_chans / embed_dim are the totals over all groups and the
+    # output channels are ordered by group
+    def __init__(self, img_size=(128, 128, 128), patch_size=(4, 4, 4), in_chans=1, embed_dim=64, norm_layer=None,
+                 groups=1):
         super().__init__()
 
         self.patch_size = patch_size
         self.in_chans = in_chans
         self.embed_dim = embed_dim
+        self.groups = groups
         self.patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1], img_size[1] // patch_size[1]]
 
         # self.proj = nn.Conv3d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size) big kernel convolution
-        self.proj = Conv_Stem(in_chans, embed_dim)
+        self.proj = Conv_Stem(in_chans, embed_dim, groups=groups)
+        self.proj.to(memory_format=torch.channels_last_3d)
         if norm_layer is not None:
-            self.norm = norm_layer(embed_dim)
+            # 每个 group 各自的 LayerNorm
+            self.norm = GroupedLayerNorm(embed_dim // groups, groups=groups)
         else:
             self.norm = None
 
@@ -776,12 +879,13 @@ class PatchEmbed3D(nn.Module):
         if D % self.patch_size[0] != 0:
             x = F.pad(x, (0, 0, 0, 0, 0, self.patch_size[0] - D % self.patch_size[0]))
 
-        x_2, x = self.proj(x)
+        # x_2: B, C, D, H, W (stride 2); x: G, B, D, H, W, C/G (stride 4)，每个 group 一个 b d h w c 的特征图
+        # stem 在 channels_last_3d 下计算，下面的 view + permute 得到的 b d h w c 张量最后一维是连续的
+        x_2, x = self.proj(x.contiguous(memory_format=torch.channels_last_3d))
+        B, C, D, H, W = x.shape
+        x = x.view(B, self.groups, C // self.groups, D, H, W).permute(1, 0, 3, 4, 5, 2)
         if self.norm is not None:
-            D, H, W = x.size(2), x.size(3), x.size(4)
-            x = x.flatten(2).transpose(1, 2)
             x = self.norm(x)
-            x = x.transpose(1, 2).view(-1, self.embed_dim, D, H, W)
         return x_2, x
 
 
@@ -801,17 +905,16 @@ class Encoder(nn.Module):
         self.num_features = int(embed_dim * 2 ** (self.num_layers - 1))
         self.mlp_ratio = mlp_ratio
         self.window_size = window_size
+        self.attn_drop_rate = attn_drop_rate
+        # 移位窗口注意力是否改用 flex_attention，见 extract 的 use_flex_attention
+        self.use_flex_attention = False
         # split image into non-overlapping patches
-        self.patch_embed_t1 = PatchEmbed3D(img_size=img_size, patch_size=patch_size, in_chans=in_chans,
-                                           embed_dim=embed_dim, norm_layer=norm_layer if self.patch_norm else None)
-        self.patch_embed_t1ce = PatchEmbed3D(img_size=img_size, patch_size=patch_size, in_chans=in_chans,
-                                             embed_dim=embed_dim, norm_layer=norm_layer if self.patch_norm else None)
-        self.patch_embed_t2 = PatchEmbed3D(img_size=img_size, patch_size=patch_size, in_chans=in_chans,
-                                           embed_dim=embed_dim, norm_layer=norm_layer if self.patch_norm else None)
-        self.patch_embed_flair = PatchEmbed3D(img_size=img_size, patch_size=patch_size, in_chans=in_chans,
-                                              embed_dim=embed_dim, norm_layer=norm_layer if self.patch_norm else None)
+        # t1, t1ce, t2, flair 各自的 patch embedding 作为 4 个 group 在一次分组卷积中完成
+        self.patch_embed = PatchEmbed3D(img_size=img_size, patch_size=patch_size, in_chans=in_chans * 4,
+                                        embed_dim=embed_dim * 4, norm_layer=norm_layer if self.patch_norm else None,
+                                        groups=4)
 
-        self.patches_resolution = self.patch_embed_t1.patches_resolution
+        self.patches_resolution = self.patch_embed.patches_resolution
 
         self.pos_drop = nn.Dropout(p=drop_rate)
 
@@ -844,49 +947,137 @@ class Encoder(nn.Module):
         ])
         self.norm = norm_layer((embed_dim * 2 ** (i_layer + 1)) * 4)
 
-    def forward(self, t1, t1ce, t2, flair):
+        # 输入为 img_size 时，每一层和 bottleneck 的特征图尺寸在构造时就已确定，attention mask 预先算好存为 buffer
+        # patch embedding 先把输入补齐到 patch_size 的整数倍，Conv_Stem 再做两次 stride 2 的卷积
+        resolution = tuple(((i + p - 1) // p * p + 1) // 2 for i, p in zip(img_size, patch_size))
+        self.mask_resolutions = self._mask_resolutions(tuple((r + 1) // 2 for r in resolution))
+        for i, resolution in enumerate(self.mask_resolutions):
+            self.register_buffer('attn_mask_%d' % i, get_attn_mask(
+                resolution, window_size, tuple(w // 2 for w in window_size), 'cpu'), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧 checkpoint 中每个模态各有一个 patch_embed_{t1, t1ce, t2, flair}，沿输出通道拼成分组的 patch_embed
+        _merge_old_keys(state_dict, prefix, ['patch_embed_%s.' % m for m in ('t1', 't1ce', 't2', 'flair')],
+                        'patch_embed.', torch.cat)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _mask_resolutions(self, resolution):
+        # patch embedding 之后的特征图尺寸为 resolution 时，每一层和 bottleneck 的特征图尺寸
+        resolutions = []
+        for i in range(self.num_layers + 1):
+            resolutions.append(resolution)
+            resolution = tuple((r + 1) // 2 for r in resolution)  # PatchMerging: kernel 3, stride 2, padding 1
+        return resolutions
+
+    def _attn_mask(self, i, x_size, device):
+        # 输入尺寸与构造时一致时直接使用预先算好的 mask
+        if x_size == self.mask_resolutions[i]:
+            return getattr(self, 'attn_mask_%d' % i)
+        return get_attn_mask(x_size, self.window_size, tuple(w // 2 for w in self.window_size), device)
+
+    def _use_flex(self, x):
+        # flex_attention 只在 GPU 上使用，且不支持 attention dropout
+        return (self.use_flex_attention and flex_attention is not None and x.is_cuda
+                and not (self.training and self.attn_drop_rate > 0))
+
+    @torch.compiler.disable
+    def _flex_block_masks(self, resolutions, device):
+        # 在 torch.compile 的图外查缓存：编译时 lru_cache 会被忽略，create_block_mask 每次前向都会重新执行
+        return [_flex_block_mask(self._attn_mask(i, r, device)) for i, r in enumerate(resolutions)]
+
+    def forward(self, x):
+        # x: B, 4 * in_chans, D, H, W，通道按 t1, t1ce, t2, flair 排列
         extract_feature = []
-        t1_2, t1 = self.patch_embed_t1(t1)
-        t1ce_2, t1ce = self.patch_embed_t1ce(t1ce)
-        t2_2, t2 = self.patch_embed_t2(t2)
-        flair_2, flair = self.patch_embed_flair(flair)
-        t1, t1ce, t2, flair = self.pos_drop(t1), self.pos_drop(t1ce), self.pos_drop(t2), self.pos_drop(flair)
+        x_2, x = self.patch_embed(x)
+        t1, t1ce, t2, flair = self.pos_drop(x).unbind(0)  # b d h w c
+
+        # 各层的 mask 按 patch embedding 实际输出的尺寸一次取好
+        resolutions = self._mask_resolutions(tuple(t1.shape[1:4]))
+        if self._use_flex(t1):
+            attn_masks = self._flex_block_masks(resolutions, t1.device)
+        else:
+            attn_masks = [self._attn_mask(i, r, t1.device) for i, r in enumerate(resolutions)]
 
         for i, layer in enumerate(self.layers):
-            extract_feature, t1, t1ce, t2, flair = layer(t1, t1ce, t2, flair, extract_feature)
-        x = torch.cat([t1, t1ce, t2, flair], dim=1)
-        B, C, D, H, W = x.shape
-        shift_size = tuple(i // 2 for i in self.window_size)
-        window_size, shift_size = get_window_size((D, H, W), self.window_size, shift_size)
-
-        Dp = int(np.ceil(D / window_size[0])) * window_size[0]
-        Hp = int(np.ceil(H / window_size[1])) * window_size[1]
-        Wp = int(np.ceil(W / window_size[2])) * window_size[2]
-        attn_mask = compute_mask(Dp, Hp, Wp, window_size, shift_size, x.device)
-        x = rearrange(x, 'n c d h w -> n d h w c')
+            extract_feature, t1, t1ce, t2, flair = layer(t1, t1ce, t2, flair, extract_feature,
+                                                         attn_mask=attn_masks[i])
+        x = torch.cat([t1, t1ce, t2, flair], dim=-1)  # b d h w c
+        attn_mask = attn_masks[self.num_layers]
         for i, layer in enumerate(self.bottleneck):
             x = layer(x, attn_mask)
         x = self.norm(x)
-        x = rearrange(x, 'n d h w c -> n c d h w')
+        x = x.permute(0, 4, 1, 2, 3)
 
-        return torch.cat([t1_2, t1ce_2, t2_2, flair_2], dim=1), extract_feature[0], extract_feature[1], extract_feature[2], x
+        return x_2, extract_feature[0], extract_feature[1], extract_feature[2], x
 
 
 class extract(nn.Module):
         def __init__(self, embed_dim, output_dim, img_size, patch_size, in_chans, depths, num_heads, window_size,
-                     mlp_ratio):
+                     mlp_ratio, compile_mode=None, autocast_dtype=None, use_flex_attention=False, cuda_graph=False):
             super().__init__()
+            # 例如 torch.bfloat16：卷积和矩阵乘在低精度下计算，LayerNorm / softmax 等仍由 autocast 保持在 fp32
+            self.autocast_dtype = autocast_dtype
             self.encoder = Encoder(embed_dim=embed_dim, img_size=img_size, patch_size=patch_size, in_chans=in_chans,
                                    depths=depths, num_heads=num_heads, window_size=window_size, mlp_ratio=mlp_ratio)
+            # GPU 上移位窗口注意力改用 flex_attention（与 compile_mode 一起使用）；不可用或有 attention dropout 时仍走 SDPA
+            self.encoder.use_flex_attention = use_flex_attention
+            if compile_mode is not None:
+                # 输入的 patch 尺寸固定，按静态形状编译（例如 'max-autotune'）；原地编译，state_dict 的键不变
+                self.encoder.compile(mode=compile_mode, dynamic=False)
+            # 输入尺寸固定时，GPU 上第一次前向把整个 encoder（前向和反向）录成 CUDA graph，之后每步只 replay；
+            # 输入的形状 / dtype / 设备或梯度模式与录制时不同的调用走普通 forward（train / eval 不同时 torch 自己会回退）。
+            # compile_mode='reduce-overhead' 本身也用 CUDA graph，两者二选一
+            self.cuda_graph = cuda_graph
+            self._graph_key = None
+            self._eager_forward = None
 
         def forward(self, inputs):
-            t1, t1ce, t2, flair = inputs[:, 0, :, :, :].unsqueeze(1), inputs[:, 1, :, :, :].unsqueeze(1), inputs[:, 2, :
-            , :, :].unsqueeze(1), inputs[:, 3, :, :, :].unsqueeze(1)
-            z1, z2, z3, z4, z5 = self.encoder(t1, t1ce, t2, flair)
-            z0 = torch.cat([t1, t1ce, t2, flair], dim=1)
+            # inputs: B, 4, D, H, W (t1, t1ce, t2, flair)，直接送入分组的 patch embedding
+            # CUDA graph 不支持 autocast 的权重缓存
+            with torch.autocast(inputs.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None,
+                                cache_enabled=not self.cuda_graph):
+                # 录下的 graph 只对同样的输入和梯度模式有效：copy_ 会广播（batch 1 的输入会被当成录制时的 batch），
+                # no_grad 下录制的 graph 也不会产生梯度
+                key = (inputs.shape, inputs.dtype, inputs.device, torch.is_grad_enabled())
+                if self.cuda_graph and self._graph_key is None and inputs.is_cuda:
+                    # 原地替换 encoder.forward，原来的 forward 留作回退；warmup 时 mask / 相对位置偏置等缓存都已建好，
+                    # 录制过程中不再有 H2D 拷贝。最后一个 block 以外的 cross attention 不参与计算，其参数没有梯度
+                    self._eager_forward = self.encoder.forward
+                    torch.cuda.make_graphed_callables(self.encoder, (inputs.detach().clone(),),
+                                                      allow_unused_input=True)
+                    self._graph_key = key
+                if self._graph_key is not None and key != self._graph_key:
+                    z1, z2, z3, z4, z5 = self._eager_forward(inputs)
+                else:
+                    z1, z2, z3, z4, z5 = self.encoder(inputs)
+            z0 = inputs
             return z0, z1, z2, z3, z4, z5
 
 
+def export_torchscript(model, example_inputs, path=None):
+    # 部署用：按示例输入 trace（输入尺寸固定，shift / padding 分支和 mask 在 trace 时定下来），冻结后保存到 path；
+    # 返回再经 optimize_for_inference（conv 融合，CPU 上改写为 oneDNN 布局）的模块。这一步与硬件相关且结果不能序列化，
+    # 部署端 torch.jit.load 之后再调用一次 torch.jit.optimize_for_inference。
+    # 相对位置偏置在 no_grad 下首次调用时才写入缓存，两次 trace 的图不同但结果相同，所以跳过 check_trace
+    # oneDNN 融合开关和 model 的 train / eval 状态在导出后恢复原样
+    if not isinstance(example_inputs, tuple):
+        example_inputs = (example_inputs,)
+    onednn_fusion = torch.jit.onednn_fusion_enabled()
+    training = model.training
+    try:
+        if all(t.device.type == 'cpu' for t in example_inputs):
+            torch.jit.enable_onednn_fusion(True)
+        model.eval()
+        with torch.no_grad():
+            frozen = torch.jit.freeze(torch.jit.trace(model, example_inputs, check_trace=False))
+            if path is not None:
+                frozen.save(path)
+            return torch.jit.optimize_for_inference(frozen)
+    finally:
+        torch.jit.enable_onednn_fusion(onednn_fusion)
+        model.train(training)
+
+
 class SpacialAttention3D(nn. Module):
     def __init__(self, kernel_size=7):
         super(SpacialAttention3D, self).__init__()
@@ -895,15 +1086,30 @@ class SpacialAttention3D(nn. Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        max_pool_out,_ = torch.max(x, dim=1, keepdim=True)
-        mean_pool_out = torch.mean(x, dim=1, keepdim=True)
-        pool_out = torch.cat([max_pool_out, mean_pool_out], dim=1)
+        # amax 不生成 argmax 索引；两个池化结果直接 stack 成 (b, 2, h, w, d)
+        pool_out = torch.stack([x.amax(dim=1), x.mean(dim=1)], dim=1)
         out = self.conv(pool_out)
         out = self.sigmoid(out)
 
         return out
 
 
+def deform_sample_3d(x, p, max_idx, padding):
+    # x: (b, c, H, W, D) padded input; p: (b, 3, N, h, w, d) sampling coords; returns (b, c * N, h, w, d)
+    b, _, N, h, w, d = p.shape
+    # sampling points that fall into the zero padding are snapped to the integer grid (no gradient)
+    mask = (p < padding) | (p > max_idx - padding)
+    p = torch.where(mask, p.detach().floor(), p)
+
+    # trilinear sampling of all N points in one grid_sample call: coords normalized to [-1, 1]
+    # (align_corners=True, clamped to the padded volume) and ordered (d, w, h) as grid_sample expects
+    grid = (2 * p / max_idx - 1).clamp(-1, 1)
+    grid = grid.flip(1).permute(0, 2, 3, 4, 5, 1).reshape(b, N * h, w, d, 3)
+    # (b, c, N * h, w, d) -> (b, c * N, h, w, d)
+    x_offset = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=True)
+    return x_offset.view(b, -1, h, w, d)
+
+
 # MS-ADC
 class AttDeformConv3d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=False, se_ratio=4):
@@ -923,8 +1129,17 @@ class AttDeformConv3d(nn.Module):
         self.conv_kernel = nn.Conv3d(se_channels * N, out_channels, kernel_size=1, bias=bias)
         self.offset_conv_kernel = nn.Conv3d(se_channels, N * 3, kernel_size=kernel_size, padding=padding, bias=bias)
         self.att = SpacialAttention3D()  # add by jy
+        self.to(memory_format=torch.channels_last_3d)
 
         self.mode = "deformable"
+        # 采样函数，compile_sampler() 可换成 torch.compile 后的版本
+        self.sampler = deform_sample_3d
+        # 采样网格的基准位置 p_0 + p_n 只与 (h, w, d) 有关，按尺寸、dtype 和 device 缓存
+        self._grid_cache = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        self._grid_cache = {}
+        return super()._apply(fn, *args, **kwargs)
 
     def deformable_mode(self, on=True):  #
         if on:
@@ -932,186 +1147,67 @@ class AttDeformConv3d(nn.Module):
         else:
             self.mode = "regular"
 
+    def compile_sampler(self, on=True, mode=None):
+        # 把采样坐标的逐元素运算与 grid_sample 交给 torch.compile 融合，省掉 (b, 3, N, h, w, d) 的中间张量
+        if on:
+            self.sampler = torch.compile(deform_sample_3d, mode=mode, dynamic=False)
+        else:
+            self.sampler = deform_sample_3d
+
     def forward(self, x):
         # jy
-        x = self.conv_se(x)
+        x = self.conv_se(x.contiguous(memory_format=torch.channels_last_3d))
 
         if self.mode == "deformable":
             offset = self.offset_conv_kernel(x)
             offset = offset * self.att(offset)
         else:
             b, c, h, w, d = x.size()
-            offset = torch.zeros(b, 3 * self.kernel_size ** 3, h, w, d).to(x)
+            offset = x.new_zeros(b, 3 * self.kernel_size ** 3, h, w, d)
 
-        dtype = offset.data.type()
-        ks = self.kernel_size
         N = offset.size(1) // 3
 
         if self.padding:
             x = self.zero_padding(x)
 
         # (b, 3N, h, w, d)
-        p = self._get_p(offset, dtype)
+        p = self._get_p(offset)
         p = p[:, :, ::self.stride, ::self.stride, ::self.stride]
+        b, _, h, w, d = p.size()
+        # (b, 3, N, h, w, d), 3 - (h, w, d) coords of the N sampling points
+        p = p.reshape(b, 3, N, h, w, d)
 
-        # (b, h, w, d, 3N), N == ks ** 3, 3N - 3 coords for each point on the activation map
-        p = p.contiguous().permute(0, 2, 3, 4, 1)  # 5D array
-
-        q_sss = Variable(p.data, requires_grad=False).floor()  # point with all smaller coords
-        #         q_sss = p.data.floor() - same? / torch.Tensor(p.data).floor()
-        q_lll = q_sss + 1  # all larger coords
-
-        # 8 neighbor points with integer coords
-        q_sss = torch.cat([
-            torch.clamp(q_sss[..., :N], 0, x.size(2) - 1),  # h_coord
-            torch.clamp(q_sss[..., N:2 * N], 0, x.size(3) - 1),  # w_coord
-            torch.clamp(q_sss[..., 2 * N:], 0, x.size(4) - 1)  # d_coord
-        ], dim=-1).long()
-        q_lll = torch.cat([
-            torch.clamp(q_lll[..., :N], 0, x.size(2) - 1),  # h_coord
-            torch.clamp(q_lll[..., N:2 * N], 0, x.size(3) - 1),  # w_coord
-            torch.clamp(q_lll[..., 2 * N:], 0, x.size(4) - 1)  # d_coord
-        ], dim=-1).long()
-        q_ssl = torch.cat([q_sss[..., :N], q_sss[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_sls = torch.cat([q_sss[..., :N], q_lll[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-        q_sll = torch.cat([q_sss[..., :N], q_lll[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_lss = torch.cat([q_lll[..., :N], q_sss[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-        q_lsl = torch.cat([q_lll[..., :N], q_sss[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_lls = torch.cat([q_lll[..., :N], q_lll[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-
-        # (b, h, w, d, N)
-        mask = torch.cat([
-            p[..., :N].lt(self.padding) + p[..., :N].gt(x.size(2) - 1 - self.padding),
-            p[..., N:2 * N].lt(self.padding) + p[..., N:2 * N].gt(x.size(3) - 1 - self.padding),
-            p[..., 2 * N:].lt(self.padding) + p[..., 2 * N:].gt(x.size(4) - 1 - self.padding),
-        ], dim=-1).type_as(p)
-        mask = mask.detach()
-        floor_p = p - (p - torch.floor(p))  # все еще непонятно, что тут происходит за wtf
-        p = p * (1 - mask) + floor_p * mask
-
-        p = torch.cat([
-            torch.clamp(p[..., :N], 0, x.size(2) - 1),
-            torch.clamp(p[..., N:2 * N], 0, x.size(3) - 1),
-            torch.clamp(p[..., 2 * N:], 0, x.size(4) - 1),
-        ], dim=-1)
-
-        # trilinear kernel (b, h, w, d, N)
-        g_sss = (1 + (q_sss[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_sss[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_sss[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lll = (1 - (q_lll[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_lll[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_lll[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_ssl = (1 + (q_ssl[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_ssl[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_ssl[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_sls = (1 + (q_sls[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_sls[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_sls[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_sll = (1 + (q_sll[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_sll[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_sll[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lss = (1 - (q_lss[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_lss[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_lss[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lsl = (1 - (q_lsl[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_lsl[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_lsl[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lls = (1 - (q_lls[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_lls[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_lls[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-
-        # get values in all 8 neighbor points
-        # (b, c, h, w, d, N) - 6D-array
-        x_q_sss = self._get_x_q(x, q_sss, N)
-        x_q_lll = self._get_x_q(x, q_lll, N)
-        x_q_ssl = self._get_x_q(x, q_ssl, N)
-        x_q_sls = self._get_x_q(x, q_sls, N)
-        x_q_sll = self._get_x_q(x, q_sll, N)
-        x_q_lss = self._get_x_q(x, q_lss, N)
-        x_q_lsl = self._get_x_q(x, q_lsl, N)
-        x_q_lls = self._get_x_q(x, q_lls, N)
-
-        # (b, c, h, w, d, N)
-        x_offset = g_sss.unsqueeze(dim=1) * x_q_sss + \
-                   g_lll.unsqueeze(dim=1) * x_q_lll + \
-                   g_ssl.unsqueeze(dim=1) * x_q_ssl + \
-                   g_sls.unsqueeze(dim=1) * x_q_sls + \
-                   g_sll.unsqueeze(dim=1) * x_q_sll + \
-                   g_lss.unsqueeze(dim=1) * x_q_lss + \
-                   g_lsl.unsqueeze(dim=1) * x_q_lsl + \
-                   g_lls.unsqueeze(dim=1) * x_q_lls
-
-        x_offset = self._reshape_x_offset(x_offset, ks)
+        # (b, c * N, h, w, d)
+        x_offset = self.sampler(x, p, self._get_max_idx(x, p), self.padding)
         out = self.conv_kernel(x_offset)
 
         return out
 
-    def _get_p_n(self, N, dtype):
-        p_n_x, p_n_y, p_n_z = np.meshgrid(
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            indexing='ij')
-
-        # (3N, 1) - 3 coords for each of N offsets
-        # (x1, ... xN, y1, ... yN, z1, ... zN)
-        p_n = np.concatenate((p_n_x.flatten(), p_n_y.flatten(), p_n_z.flatten()))
-        p_n = np.reshape(p_n, (1, 3 * N, 1, 1, 1))
-        p_n = torch.from_numpy(p_n).type(dtype)
-
-        return p_n
-
-    @staticmethod
-    def _get_p_0(h, w, d, N, dtype):
-        p_0_x, p_0_y, p_0_z = np.meshgrid(range(1, h + 1), range(1, w + 1), range(1, d + 1), indexing='ij')
-        p_0_x = p_0_x.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0_y = p_0_y.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0_z = p_0_z.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0 = np.concatenate((p_0_x, p_0_y, p_0_z), axis=1)
-        p_0 = torch.from_numpy(p_0).type(dtype)
-
-        return p_0
-
-    def _get_p(self, offset, dtype):
+    def _get_p(self, offset):
         N, h, w, d = offset.size(1) // 3, offset.size(2), offset.size(3), offset.size(4)
-
-        # (1, 3N, 1, 1, 1)
-        p_n = self._get_p_n(N, dtype).to(offset)
+        key = (h, w, d, offset.dtype, offset.device)
+        if key not in self._grid_cache:
+            self._grid_cache[key] = self._get_p_base(N, h, w, d, offset.dtype, offset.device)
+        # (b, 3N, h, w, d)
+        return self._grid_cache[key] + offset
+
+    def _get_max_idx(self, x, p):
+        # (1, 3, 1, 1, 1, 1) - largest valid (h, w, d) index of the padded input, cached like the base grid
+        key = (tuple(x.shape[2:]), p.dtype, p.device)
+        if key not in self._grid_cache:
+            self._grid_cache[key] = p.new_tensor(x.shape[2:]).view(1, 3, 1, 1, 1, 1) - 1
+        return self._grid_cache[key]
+
+    def _get_p_base(self, N, h, w, d, dtype, device):
+        # p_n: (3, N, 1, 1, 1) - offsets of the N kernel points, (x1, ... xN, y1, ... yN, z1, ... zN)
+        r = torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1, device=device, dtype=dtype)
+        p_n = torch.stack(torch.meshgrid(r, r, r, indexing='ij')).view(3, N, 1, 1, 1)
+        # p_0: (3, 1, h, w, d) - kernel centers, starting from 1
+        p_0 = torch.stack(torch.meshgrid(torch.arange(1, h + 1, device=device, dtype=dtype),
+                                         torch.arange(1, w + 1, device=device, dtype=dtype),
+                                         torch.arange(1, d + 1, device=device, dtype=dtype), indexing='ij'))
         # (1, 3N, h, w, d)
-        p_0 = self._get_p_0(h, w, d, N, dtype).to(offset)
-        p = p_0 + p_n + offset
-
-        return p
-
-    def _get_x_q(self, x, q, N):
-        b, h, w, d, _ = q.size()
-
-        #           (0, 1, 2, 3, 4)
-        # x.size == (b, c, h, w, d)
-        padded_w = x.size(3)
-        padded_d = x.size(4)
-        c = x.size(1)
-        # (b, c, h*w*d)
-        x = x.contiguous().view(b, c, -1)
-
-        # (b, h, w, d, N)
-        # offset_x * w * d + offset_y * d + offset_z
-        index = q[..., :N] * padded_w * padded_d + q[..., N:2 * N] * padded_d + q[..., 2 * N:]
-        # (b, c, h*w*d*N)
-        index = index.contiguous().unsqueeze(dim=1).expand(-1, c, -1, -1, -1, -1).contiguous().view(b, c, -1)
-
-        x_offset = x.gather(dim=-1, index=index).contiguous().view(b, c, h, w, d, N)
-
-        return x_offset
-
-    @staticmethod
-    def _reshape_x_offset(x_offset, ks):
-        b, c, h, w, d, N = x_offset.size()
-        x_offset = x_offset.permute(0, 1, 5, 2, 3, 4)
-        x_offset = x_offset.contiguous().view(b, c * N, h, w, d)
-
-        return x_offset
+        return (p_0.unsqueeze(1) + p_n).view(1, 3 * N, h, w, d)
 
 
 
@@ -0,0 +1,152 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import model  # noqa: E402
+
+
+def _encoder(**kwargs):
+    torch.manual_seed(0)
+    kwargs = dict(dict(embed_dim=8, img_size=(32, 32, 32), patch_size=(4, 4, 4), in_chans=1, depths=[2, 2, 2],
+                       num_heads=[2, 2, 4, 4], window_size=(4, 4, 4)), **kwargs)
+    return model.Encoder(**kwargs).eval()
+
+
+@pytest.mark.parametrize('patch_size', [(4, 4, 4), (2, 2, 2)])
+@pytest.mark.parametrize('size', [(32, 32, 32), (30, 36, 28)])
+def test_encoder_masks_follow_feature_size(patch_size, size):
+    # Conv_Stem 总是下采样 4 倍，与 patch_size 无关；每一层的 mask 必须与实际特征图尺寸一致
+    encoder = _encoder(patch_size=patch_size)
+    with torch.no_grad():
+        x_2, ef0, ef1, ef2, x = encoder(torch.randn(1, 4, *size))
+    stem = tuple(((s + p - 1) // p * p + 1) // 2 for s, p in zip(size, patch_size))
+    assert x_2.shape[2:] == stem
+    assert ef0.shape[2:] == tuple((s + 1) // 2 for s in stem)
+    assert x.shape[0] == 1 and x.shape[1] == 8 * 4 * 2 ** 3
+
+
+def test_encoder_mask_buffers_match_img_size():
+    # 输入为 img_size 时直接使用构造时预先算好的 mask buffer
+    for patch_size in [(4, 4, 4), (2, 2, 2)]:
+        encoder = _encoder(patch_size=patch_size)
+        calls = []
+        get_attn_mask = model.get_attn_mask
+        model.get_attn_mask = lambda *a, **k: (calls.append(a[0]), get_attn_mask(*a, **k))[1]
+        try:
+            with torch.no_grad():
+                encoder(torch.randn(1, 4, 32, 32, 32))
+        finally:
+            model.get_attn_mask = get_attn_mask
+        assert calls == []
+
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graph needs a GPU')
+def test_extract_cuda_graph_replay_and_fallbacks():
+    kwargs = dict(embed_dim=8, output_dim=8, img_size=(32, 32, 32), patch_size=(4, 4, 4), in_chans=1,
+                  depths=[2, 2, 2], num_heads=[2, 2, 4, 4], window_size=(4, 4, 4), mlp_ratio=4.)
+    torch.manual_seed(0)
+    net = model.extract(cuda_graph=True, **kwargs).cuda().eval()
+    reference = model.extract(**kwargs).cuda().eval()
+    reference.load_state_dict(net.state_dict())
+
+    def check(inputs, grad=True):
+        with torch.set_grad_enabled(grad):
+            outputs = net(inputs)
+            expected = reference(inputs)
+        for out, exp in zip(outputs, expected):
+            torch.testing.assert_close(out, exp, rtol=1e-4, atol=1e-4)
+        return outputs
+
+    # 第一次调用录制，之后同样的输入 replay，梯度正常回传
+    check(torch.randn(2, 4, 32, 32, 32, device='cuda'))
+    eager_calls = []
+    eager_forward = net._eager_forward
+    net._eager_forward = lambda x: (eager_calls.append(tuple(x.shape)), eager_forward(x))[1]
+    outputs = check(torch.randn(2, 4, 32, 32, 32, device='cuda'))
+    sum(o.sum() for o in outputs[1:]).backward()
+    assert any(p.grad is not None and p.grad.abs().sum() > 0 for p in net.parameters())
+    assert eager_calls == []
+
+    # batch 与录制时不同（copy_ 会广播）：走普通 forward
+    check(torch.randn(1, 4, 32, 32, 32, device='cuda'))
+    assert eager_calls == [(1, 4, 32, 32, 32)]
+
+    # 梯度模式与录制时不同：同样走普通 forward
+    check(torch.randn(2, 4, 32, 32, 32, device='cuda'), grad=False)
+    assert eager_calls == [(1, 4, 32, 32, 32), (2, 4, 32, 32, 32)]
+
+
+def test_export_torchscript_restores_state(tmp_path):
+    encoder = _encoder().train()
+    onednn_fusion = torch.jit.onednn_fusion_enabled()
+    inputs = torch.randn(1, 4, 32, 32, 32)
+    scripted = model.export_torchscript(encoder, inputs, str(tmp_path / 'encoder.pt'))
+    assert encoder.training
+    assert torch.jit.onednn_fusion_enabled() == onednn_fusion
+    with torch.no_grad():
+        expected = encoder.eval()(inputs)
+        outputs = scripted(inputs)
+    for out, exp in zip(outputs, expected):
+        torch.testing.assert_close(out, exp, rtol=1e-4, atol=1e-4)
+
+
+def _per_modality_state_dict(block):
+    # 把分组 block 的参数拆回旧 checkpoint 中逐模态的键名和形状
+    modalities = ('t1', 't1ce', 't2', 'flair')
+    state_dict = {}
+    for key, t in block.state_dict().items():
+        module, name = key.split('.', 1)
+        if module in ('norm1', 'norm2'):
+            for m, v in zip(modalities, t):
+                state_dict['norm_%s_%s.%s' % (m, module[-1], name)] = v
+        elif module == 'self_attn':
+            for m, v in zip(modalities, t if name != 'relative_position_index' else [t] * 4):
+                state_dict['self_attn_%s.%s' % (m, name)] = v
+        elif module == 'cross_attn':
+            for j, v in enumerate(t if name != 'relative_position_index' else [t] * 2):
+                if name.startswith('kv.'):
+                    k, v = v.chunk(2, dim=0)
+                    state_dict['cross_attn_%d.key.%s' % (j + 1, name[3:])] = k
+                    state_dict['cross_attn_%d.value.%s' % (j + 1, name[3:])] = v
+                else:
+                    state_dict['cross_attn_%d.%s' % (j + 1, name)] = v
+        else:
+            for m, v in zip(modalities, t.chunk(4, dim=0)):
+                state_dict['mlp_%s.%s' % (m, name)] = v
+    return state_dict
+
+
+def test_block_loads_per_modality_checkpoint():
+    torch.manual_seed(0)
+    block = model.SwinTransformerBlock3D(dim=8, num_heads=2, window_size=(4, 4, 4), shift_size=(2, 2, 2)).eval()
+    for p in block.parameters():
+        torch.nn.init.normal_(p, std=0.2)
+    loaded = model.SwinTransformerBlock3D(dim=8, num_heads=2, window_size=(4, 4, 4), shift_size=(2, 2, 2)).eval()
+    loaded.load_state_dict(_per_modality_state_dict(block))
+    xs = [torch.randn(2, 6, 7, 5, 8) for _ in range(4)]
+    mask = model.get_attn_mask((6, 7, 5), (4, 4, 4), (2, 2, 2), 'cpu')
+    with torch.no_grad():
+        for out, exp in zip(loaded(*xs, mask, True), block(*xs, mask, True)):
+            torch.testing.assert_close(out, exp)
+
+
+def test_coordatt_and_cca_load_old_checkpoints():
+    torch.manual_seed(0)
+    coord_att = model.CoordAtt(16, 16).eval()
+    old = {k: v for k, v in coord_att.state_dict().items() if not k.startswith('conv_dhw.')}
+    for p in ('weight', 'bias'):
+        for axis, v in zip('dhw', coord_att.state_dict()['conv_dhw.' + p].chunk(3)):
+            old['conv_%s.%s' % (axis, p)] = v
+    loaded = model.CoordAtt(16, 16).eval()
+    loaded.load_state_dict(old)
+    assert all(torch.equal(a, b) for a, b in zip(loaded.state_dict().values(), coord_att.state_dict().values()))
+
+    cca = model.CCA(8, 16)
+    old = {k.replace('.', '.1.', 1): v.flatten(1) if k.endswith('weight') else v for k, v in cca.state_dict().items()}
+    loaded = model.CCA(8, 16)
+    loaded.load_state_dict(old)
+    assert all(torch.equal(a, b) for a, b in zip(loaded.state_dict().values(), cca.state_dict().values()))
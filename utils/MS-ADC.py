@@ -1,7 +1,6 @@
-from torch.autograd import Variable
 import torch
 from torch import nn
-import numpy as np
+import torch.nn.functional as F
 
 
 class SpacialAttention3D(nn. Module):
@@ -12,15 +11,30 @@ class SpacialAttention3D(nn. Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        max_pool_out,_ = torch.max(x, dim=1, keepdim=True)
-        mean_pool_out = torch.mean(x, dim=1, keepdim=True)
-        pool_out = torch.cat([max_pool_out, mean_pool_out], dim=1)
+        # amax 不生成 argmax 索引；两个池化结果直接 stack 成 (b, 2, h, w, d)
+        pool_out = torch.stack([x.amax(dim=1), x.mean(dim=1)], dim=1)
         out = self.conv(pool_out)
         out = self.sigmoid(out)
 
         return out
 
 
+def deform_sample_3d(x, p, max_idx, padding):
+    # x: (b, c, H, W, D) padded input; p: (b, 3, N, h, w, d) sampling coords; returns (b, c * N, h, w, d)
+    b, _, N, h, w, d = p.shape
+    # sampling points that fall into the zero padding are snapped to the integer grid (no gradient)
+    mask = (p < padding) | (p > max_idx - padding)
+    p = torch.where(mask, p.detach().floor(), p)
+
+    # trilinear sampling of all N points in one grid_sample call: coords normalized to [-1, 1]
+    # (align_corners=True, clamped to the padded volume) and ordered (d, w, h) as grid_sample expects
+    grid = (2 * p / max_idx - 1).clamp(-1, 1)
+    grid = grid.flip(1).permute(0, 2, 3, 4, 5, 1).reshape(b, N * h, w, d, 3)
+    # (b, c, N * h, w, d) -> (b, c * N, h, w, d)
+    x_offset = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=True)
+    return x_offset.view(b, -1, h, w, d)
+
+
 # MS-ADC
 class AttDeformConv3d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=False, se_ratio=4):
@@ -40,8 +54,17 @@ class AttDeformConv3d(nn.Module):
         self.conv_kernel = nn.Conv3d(se_channels * N, out_channels, kernel_size=1, bias=bias)
         self.offset_conv_kernel = nn.Conv3d(se_channels, N * 3, kernel_size=kernel_size, padding=padding, bias=bias)
         self.att = SpacialAttention3D()  # add by jy
+        self.to(memory_format=torch.channels_last_3d)
 
         self.mode = "deformable"
+        # 采样函数，compile_sampler() 可换成 torch.compile 后的版本
+        self.sampler = deform_sample_3d
+        # 采样网格的基准位置 p_0 + p_n 只与 (h, w, d) 有关，按尺寸、dtype 和 device 缓存
+        self._grid_cache = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        self._grid_cache = {}
+        return super()._apply(fn, *args, **kwargs)
 
     def deformable_mode(self, on=True):  #
         if on:
@@ -49,183 +72,64 @@ class AttDeformConv3d(nn.Module):
         else:
             self.mode = "regular"
 
+    def compile_sampler(self, on=True, mode=None):
+        # 把采样坐标的逐元素运算与 grid_sample 交给 torch.compile 融合，省掉 (b, 3, N, h, w, d) 的中间张量
+        if on:
+            self.sampler = torch.compile(deform_sample_3d, mode=mode, dynamic=False)
+        else:
+            self.sampler = deform_sample_3d
+
     def forward(self, x):
         # jy
-        x = self.conv_se(x)
+        x = self.conv_se(x.contiguous(memory_format=torch.channels_last_3d))
 
         if self.mode == "deformable":
             offset = self.offset_conv_kernel(x)
             offset = offset * self.att(offset)
         else:
             b, c, h, w, d = x.size()
-            offset = torch.zeros(b, 3 * self.kernel_size ** 3, h, w, d).to(x)
+            offset = x.new_zeros(b, 3 * self.kernel_size ** 3, h, w, d)
 
-        dtype = offset.data.type()
-        ks = self.kernel_size
         N = offset.size(1) // 3
 
         if self.padding:
             x = self.zero_padding(x)
 
         # (b, 3N, h, w, d)
-        p = self._get_p(offset, dtype)
+        p = self._get_p(offset)
         p = p[:, :, ::self.stride, ::self.stride, ::self.stride]
+        b, _, h, w, d = p.size()
+        # (b, 3, N, h, w, d), 3 - (h, w, d) coords of the N sampling points
+        p = p.reshape(b, 3, N, h, w, d)
 
-        # (b, h, w, d, 3N), N == ks ** 3, 3N - 3 coords for each point on the activation map
-        p = p.contiguous().permute(0, 2, 3, 4, 1)  # 5D array
-
-        q_sss = Variable(p.data, requires_grad=False).floor()  # point with all smaller coords
-        #         q_sss = p.data.floor() - same? / torch.Tensor(p.data).floor()
-        q_lll = q_sss + 1  # all larger coords
-
-        # 8 neighbor points with integer coords
-        q_sss = torch.cat([
-            torch.clamp(q_sss[..., :N], 0, x.size(2) - 1),  # h_coord
-            torch.clamp(q_sss[..., N:2 * N], 0, x.size(3) - 1),  # w_coord
-            torch.clamp(q_sss[..., 2 * N:], 0, x.size(4) - 1)  # d_coord
-        ], dim=-1).long()
-        q_lll = torch.cat([
-            torch.clamp(q_lll[..., :N], 0, x.size(2) - 1),  # h_coord
-            torch.clamp(q_lll[..., N:2 * N], 0, x.size(3) - 1),  # w_coord
-            torch.clamp(q_lll[..., 2 * N:], 0, x.size(4) - 1)  # d_coord
-        ], dim=-1).long()
-        q_ssl = torch.cat([q_sss[..., :N], q_sss[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_sls = torch.cat([q_sss[..., :N], q_lll[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-        q_sll = torch.cat([q_sss[..., :N], q_lll[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_lss = torch.cat([q_lll[..., :N], q_sss[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-        q_lsl = torch.cat([q_lll[..., :N], q_sss[..., N:2 * N], q_lll[..., 2 * N:]], -1)
-        q_lls = torch.cat([q_lll[..., :N], q_lll[..., N:2 * N], q_sss[..., 2 * N:]], -1)
-
-        # (b, h, w, d, N)
-        mask = torch.cat([
-            p[..., :N].lt(self.padding) + p[..., :N].gt(x.size(2) - 1 - self.padding),
-            p[..., N:2 * N].lt(self.padding) + p[..., N:2 * N].gt(x.size(3) - 1 - self.padding),
-            p[..., 2 * N:].lt(self.padding) + p[..., 2 * N:].gt(x.size(4) - 1 - self.padding),
-        ], dim=-1).type_as(p)
-        mask = mask.detach()
-        floor_p = p - (p - torch.floor(p))  # все еще непонятно, что тут происходит за wtf
-        p = p * (1 - mask) + floor_p * mask
-
-        p = torch.cat([
-            torch.clamp(p[..., :N], 0, x.size(2) - 1),
-            torch.clamp(p[..., N:2 * N], 0, x.size(3) - 1),
-            torch.clamp(p[..., 2 * N:], 0, x.size(4) - 1),
-        ], dim=-1)
-
-        # trilinear kernel (b, h, w, d, N)
-        g_sss = (1 + (q_sss[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_sss[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_sss[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lll = (1 - (q_lll[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_lll[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_lll[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_ssl = (1 + (q_ssl[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_ssl[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_ssl[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_sls = (1 + (q_sls[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_sls[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_sls[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_sll = (1 + (q_sll[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_sll[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_sll[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lss = (1 - (q_lss[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_lss[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_lss[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lsl = (1 - (q_lsl[..., :N].type_as(p) - p[..., :N])) * (
-                    1 + (q_lsl[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 - (q_lsl[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-        g_lls = (1 - (q_lls[..., :N].type_as(p) - p[..., :N])) * (
-                    1 - (q_lls[..., N:2 * N].type_as(p) - p[..., N:2 * N])) * (
-                            1 + (q_lls[..., 2 * N:].type_as(p) - p[..., 2 * N:]))
-
-        # get values in all 8 neighbor points
-        # (b, c, h, w, d, N) - 6D-array
-        x_q_sss = self._get_x_q(x, q_sss, N)
-        x_q_lll = self._get_x_q(x, q_lll, N)
-        x_q_ssl = self._get_x_q(x, q_ssl, N)
-        x_q_sls = self._get_x_q(x, q_sls, N)
-        x_q_sll = self._get_x_q(x, q_sll, N)
-        x_q_lss = self._get_x_q(x, q_lss, N)
-        x_q_lsl = self._get_x_q(x, q_lsl, N)
-        x_q_lls = self._get_x_q(x, q_lls, N)
-
-        # (b, c, h, w, d, N)
-        x_offset = g_sss.unsqueeze(dim=1) * x_q_sss + \
-                   g_lll.unsqueeze(dim=1) * x_q_lll + \
-                   g_ssl.unsqueeze(dim=1) * x_q_ssl + \
-                   g_sls.unsqueeze(dim=1) * x_q_sls + \
-                   g_sll.unsqueeze(dim=1) * x_q_sll + \
-                   g_lss.unsqueeze(dim=1) * x_q_lss + \
-                   g_lsl.unsqueeze(dim=1) * x_q_lsl + \
-                   g_lls.unsqueeze(dim=1) * x_q_lls
-
-        x_offset = self._reshape_x_offset(x_offset, ks)
+        # (b, c * N, h, w, d)
+        x_offset = self.sampler(x, p, self._get_max_idx(x, p), self.padding)
         out = self.conv_kernel(x_offset)
 
         return out
 
-    def _get_p_n(self, N, dtype):
-        p_n_x, p_n_y, p_n_z = np.meshgrid(
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            range(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
-            indexing='ij')
-
-        # (3N, 1) - 3 coords for each of N offsets
-        # (x1, ... xN, y1, ... yN, z1, ... zN)
-        p_n = np.concatenate((p_n_x.flatten(), p_n_y.flatten(), p_n_z.flatten()))
-        p_n = np.reshape(p_n, (1, 3 * N, 1, 1, 1))
-        p_n = torch.from_numpy(p_n).type(dtype)
-
-        return p_n
-
-    @staticmethod
-    def _get_p_0(h, w, d, N, dtype):
-        p_0_x, p_0_y, p_0_z = np.meshgrid(range(1, h + 1), range(1, w + 1), range(1, d + 1), indexing='ij')
-        p_0_x = p_0_x.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0_y = p_0_y.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0_z = p_0_z.flatten().reshape(1, 1, h, w, d).repeat(N, axis=1)
-        p_0 = np.concatenate((p_0_x, p_0_y, p_0_z), axis=1)
-        p_0 = torch.from_numpy(p_0).type(dtype)
-
-        return p_0
-
-    def _get_p(self, offset, dtype):
+    def _get_p(self, offset):
         N, h, w, d = offset.size(1) // 3, offset.size(2), offset.size(3), offset.size(4)
-
-        # (1, 3N, 1, 1, 1)
-        p_n = self._get_p_n(N, dtype).to(offset)
+        key = (h, w, d, offset.dtype, offset.device)
+        if key not in self._grid_cache:
+            self._grid_cache[key] = self._get_p_base(N, h, w, d, offset.dtype, offset.device)
+        # (b, 3N, h, w, d)
+        return self._grid_cache[key] + offset
+
+    def _get_max_idx(self, x, p):
+        # (1, 3, 1, 1, 1, 1) - largest valid (h, w, d) index of the padded input, cached like the base grid
+        key = (tuple(x.shape[2:]), p.dtype, p.device)
+        if key not in self._grid_cache:
+            self._grid_cache[key] = p.new_tensor(x.shape[2:]).view(1, 3, 1, 1, 1, 1) - 1
+        return self._grid_cache[key]
+
+    def _get_p_base(self, N, h, w, d, dtype, device):
+        # p_n: (3, N, 1, 1, 1) - offsets of the N kernel points, (x1, ... xN, y1, ... yN, z1, ... zN)
+        r = torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1, device=device, dtype=dtype)
+        p_n = torch.stack(torch.meshgrid(r, r, r, indexing='ij')).view(3, N, 1, 1, 1)
+        # p_0: (3, 1, h, w, d) - kernel centers, starting from 1
+        p_0 = torch.stack(torch.meshgrid(torch.arange(1, h + 1, device=device, dtype=dtype),
+                                         torch.arange(1, w + 1, device=device, dtype=dtype),
+                                         torch.arange(1, d + 1, device=device, dtype=dtype), indexing='ij'))
         # (1, 3N, h, w, d)
-        p_0 = self._get_p_0(h, w, d, N, dtype).to(offset)
-        p = p_0 + p_n + offset
-
-        return p
-
-    def _get_x_q(self, x, q, N):
-        b, h, w, d, _ = q.size()
-
-        #           (0, 1, 2, 3, 4)
-        # x.size == (b, c, h, w, d)
-        padded_w = x.size(3)
-        padded_d = x.size(4)
-        c = x.size(1)
-        # (b, c, h*w*d)
-        x = x.contiguous().view(b, c, -1)
-
-        # (b, h, w, d, N)
-        # offset_x * w * d + offset_y * d + offset_z
-        index = q[..., :N] * padded_w * padded_d + q[..., N:2 * N] * padded_d + q[..., 2 * N:]
-        # (b, c, h*w*d*N)
-        index = index.contiguous().unsqueeze(dim=1).expand(-1, c, -1, -1, -1, -1).contiguous().view(b, c, -1)
-
-        x_offset = x.gather(dim=-1, index=index).contiguous().view(b, c, h, w, d, N)
-
-        return x_offset
-
-    @staticmethod
-    def _reshape_x_offset(x_offset, ks):
-        b, c, h, w, d, N = x_offset.size()
-        x_offset = x_offset.permute(0, 1, 5, 2, 3, 4)
-        x_offset = x_offset.contiguous().view(b, c * N, h, w, d)
-
-        return x_offset
\ No newline at end of file
+        return (p_0.unsqueeze(1) + p_n).view(1, 3 * N, h, w, d)